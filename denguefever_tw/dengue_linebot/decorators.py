@@ -3,7 +3,8 @@ from datetime import datetime
 
 from linebot.models import MessageEvent, TextMessage
 
-from .models import MessageLog, LineUser
+from .log_writer import log_writer
+from .models import MessageLog
 
 
 logger = logging.getLogger('django')
@@ -40,8 +41,7 @@ def log_received_event(event, state):
         else:
             content = '===This is {message_type} type message.==='.format(message_type=message_type)
 
-        message_log = MessageLog(speaker=LineUser.objects.get(user_id=user_id),
-                                 speak_time=datetime.fromtimestamp(event.timestamp/1000),
-                                 message_type=message_type,
-                                 content=content)
-        message_log.save()
+        log_writer.add(MessageLog(speaker_id=user_id,
+                                  speak_time=datetime.fromtimestamp(event.timestamp/1000),
+                                  message_type=message_type,
+                                  content=content))
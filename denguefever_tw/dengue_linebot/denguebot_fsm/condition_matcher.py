@@ -0,0 +1,175 @@
+from collections import deque
+
+
+DEFAULT_PREPROCESS_CODE = ['msg = event.message.text']
+
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton that finds every keyword in a text with one scan.
+
+    Args:
+        keywords (List[str]): keywords to find, the index of a keyword is its bit
+    """
+
+    def __init__(self, keywords):
+        self.keywords = list(keywords)
+        self._goto = [dict()]
+        self._fail = [0]
+        self._output = [0]
+
+        for index, keyword in enumerate(self.keywords):
+            node = 0
+            for char in keyword:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append(dict())
+                    self._fail.append(0)
+                    self._output.append(0)
+                node = next_node
+            self._output[node] |= 1 << index
+
+        # Breadth first search so that the fail link of a parent is ready before its children
+        nodes = deque(self._goto[0].values())
+        while nodes:
+            node = nodes.popleft()
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child] |= self._output[self._fail[child]]
+                nodes.append(child)
+
+    def scan(self, text):
+        """Find keywords in the text.
+
+        Returns:
+            int: bitset of the keywords found in the text
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        found = output[0]
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            found |= output[node]
+        return found
+
+
+class ConditionMatcher:
+    """Compile the conditions in cond_config.json into one keyword automaton.
+
+    A message is scanned once and every condition is then decided by bit
+    operations, so the cost of evaluating all the conditions depends on the
+    length of the message instead of the number of keywords.
+
+    Supported condition types are
+
+    - ``any``: the message contains any of the keywords
+    - ``all``: the message contains all of the keywords
+    - ``match``: the message is one of the keywords
+    - ``complex-any``: any of the sub-conditions is satisfied
+    - ``complex-all``: all of the sub-conditions are satisfied
+
+    Args:
+        condition_config (List[dict]): the content of cond_config.json
+        preprocess_code (List[str]): code that extracts the message from ``event``
+            for conditions without their own ``template_args.preprocess_code``
+        cond_var_name (str): name of the variable that the preprocess code assigns the message to
+        automaton (KeywordAutomaton): prebuilt automaton of the same condition config,
+            rebuilt if its keywords do not match
+    """
+
+    def __init__(self, condition_config, *, preprocess_code=None, cond_var_name='msg', automaton=None):
+        self.cond_var_name = cond_var_name
+        self.condition_names = list()
+        self._keyword_bits = dict()
+        self._predicates = list()
+        self._extractors = dict()
+        self._condition_extractors = list()
+
+        for condition in condition_config:
+            self.condition_names.append(condition['name'])
+            self._predicates.append(self._compile(condition['condition']))
+
+            code = condition.get('template_args', {}).get('preprocess_code') or preprocess_code
+            code = tuple(code or DEFAULT_PREPROCESS_CODE)
+            if code not in self._extractors:
+                self._extractors[code] = self._compile_extractor(code)
+            self._condition_extractors.append(self._extractors[code])
+
+        self._condition_indices = {name: index for index, name in enumerate(self.condition_names)}
+        keywords = sorted(self._keyword_bits, key=self._keyword_bits.get)
+        if automaton is None or automaton.keywords != keywords:
+            automaton = KeywordAutomaton(keywords)
+        self.automaton = automaton
+
+    def evaluate(self, msg):
+        """Evaluate all the conditions against a message.
+
+        Returns:
+            int: bitset of the satisfied conditions, in the order of the condition config
+        """
+        found = self.automaton.scan(msg)
+        satisfied = 0
+        for index, predicate in enumerate(self._predicates):
+            if predicate(msg, found):
+                satisfied |= 1 << index
+        return satisfied
+
+    def condition_method(self, name):
+        """Create the FSM condition method of the condition ``name``."""
+        index = self._condition_indices[name]
+        bit = 1 << index
+        extract = self._condition_extractors[index]
+
+        def condition(machine, event):
+            msg = extract(machine, event)
+            memo = machine._condition_bits
+            try:
+                satisfied = memo[msg]
+            except KeyError:
+                satisfied = memo[msg] = self.evaluate(msg)
+            return bool(satisfied & bit)
+
+        condition.__name__ = condition.__qualname__ = name
+        return condition
+
+    def _keyword_mask(self, keywords):
+        mask = 0
+        for keyword in keywords:
+            bit = self._keyword_bits.setdefault(keyword, len(self._keyword_bits))
+            mask |= 1 << bit
+        return mask
+
+    def _compile(self, condition):
+        cond_type = condition['type']
+        content = condition['content']
+        if cond_type == 'any':
+            mask = self._keyword_mask(content)
+            return lambda msg, found: bool(found & mask)
+        elif cond_type == 'all':
+            mask = self._keyword_mask(content)
+            return lambda msg, found: found & mask == mask
+        elif cond_type == 'match':
+            keywords = frozenset(content)
+            return lambda msg, found: msg in keywords
+        elif cond_type == 'complex-any':
+            predicates = [self._compile(sub_condition) for sub_condition in content]
+            return lambda msg, found: any(predicate(msg, found) for predicate in predicates)
+        elif cond_type == 'complex-all':
+            predicates = [self._compile(sub_condition) for sub_condition in content]
+            return lambda msg, found: all(predicate(msg, found) for predicate in predicates)
+        raise ValueError('Unknown condition type {}'.format(cond_type))
+
+    def _compile_extractor(self, preprocess_code):
+        lines = ['def extract(self, event):']
+        lines.extend('    ' + line for line in preprocess_code)
+        lines.append('    return {}'.format(self.cond_var_name))
+
+        namespace = dict()
+        exec(compile('\n'.join(lines), '<preprocess_code>', 'exec'), namespace)
+        return namespace['extract']
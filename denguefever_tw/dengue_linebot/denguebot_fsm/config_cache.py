@@ -0,0 +1,81 @@
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+
+import ujson
+from jsmin import jsmin
+
+from .condition_matcher import ConditionMatcher
+
+
+logger = logging.getLogger(__name__)
+
+# Bump when the content of the cached artifact changes
+CACHE_FORMAT = 1
+
+
+def config_key(fsm_config_path, cond_config_path):
+    """Content hash of FSM.json and a cond_config.json."""
+    digest = hashlib.sha1(str(CACHE_FORMAT).encode('utf-8'))
+    for path in (fsm_config_path, cond_config_path):
+        with open(path, 'rb') as config_file:
+            digest.update(config_file.read())
+    return digest.hexdigest()
+
+
+def parse_fsm_config(fsm_config_path, cond_config_path):
+    """Parse FSM.json and a cond_config.json, and build the keyword automaton of the conditions.
+
+    Returns:
+        dict: states, transitions, condition_config and automaton
+    """
+    with open(fsm_config_path) as fsm_config_file:
+        data = ujson.loads(jsmin(fsm_config_file.read()))
+    with open(cond_config_path) as cond_config_file:
+        condition_config = ujson.load(cond_config_file)
+
+    return {
+        'states': data['states'],
+        'transitions': data['transitions'],
+        'condition_config': condition_config,
+        'automaton': ConditionMatcher(condition_config).automaton,
+    }
+
+
+def load_fsm_config(fsm_config_path, cond_config_path, cache_dir=None):
+    """Load the parsed FSM config from the artifact in cache_dir.
+
+    The artifact is keyed by the content of the config files. It is built and
+    written when it is missing, so only the first load after a config change
+    pays for parsing. Caching is disabled when cache_dir is empty.
+    """
+    if not cache_dir:
+        return parse_fsm_config(fsm_config_path, cond_config_path)
+
+    cache_path = os.path.join(cache_dir, config_key(fsm_config_path, cond_config_path) + '.pickle')
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            return pickle.load(cache_file)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning('Fail to load FSM config cache %s. Rebuild it.\n %s', cache_path, str(e))
+
+    config = parse_fsm_config(fsm_config_path, cond_config_path)
+    write_fsm_config_cache(cache_path, config)
+    return config
+
+
+def write_fsm_config_cache(cache_path, config):
+    cache_dir = os.path.dirname(cache_path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first so that other workers never load a partial artifact
+        fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as temp_file:
+            pickle.dump(config, temp_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        logger.warning('Fail to write FSM config cache %s.\n %s', cache_path, str(e))
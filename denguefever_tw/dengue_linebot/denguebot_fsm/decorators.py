@@ -1,31 +1,57 @@
 import logging
 from functools import wraps
+from time import perf_counter
+
+from .tracing import current_span
 
 
 logger = logging.getLogger(__name__)
 
 
 def log_fsm_condition(func):
+    name = func.__name__
+
     @wraps(func)
-    def wrapper(*args, **kwargs):
-        result = func(*args, **kwargs)
-        logger.info('%s is %s\n', func.__name__, result)
+    def wrapper(self, *args, **kwargs):
+        # Memo of the running trigger, see IndexedEvent
+        memo = getattr(self, '_condition_memo', None)
+        if memo is not None and name in memo:
+            result = memo[name]
+        else:
+            result = func(self, *args, **kwargs)
+            if memo is not None:
+                memo[name] = result
+
+        span = current_span()
+        if span is not None:
+            span.conditions.append((name, result))
         return result
     return wrapper
 
 
 def log_fsm_operation(func):
+    name = func.__name__
+
     @wraps(func)
     def wrapper(self, *args, **kwargs):
+        span = current_span()
+        if span is None and not logger.isEnabledFor(logging.DEBUG):
+            return func(self, *args, **kwargs)
+
         pre_state = self.state
+        start = perf_counter()
         result = func(self, *args, **kwargs)
+        duration = (perf_counter() - start) * 1000
         post_state = self.state
-        logger.info(
+
+        if span is not None:
+            span.operations.append((name, pre_state, post_state, duration))
+        logger.debug(
             ('FSM Opertion\n'
              'Beforce Advance: %s\n'
              'Triggered Function: %s\n'
              'After Advance: %s\n'),
-            pre_state, func.__name__, post_state
+            pre_state, name, post_state
         )
         return result
     return wrapper
@@ -1,11 +1,12 @@
 import logging
+import threading
+from collections import OrderedDict
 from datetime import datetime
 from functools import partial
+from types import MethodType
 from urllib.parse import parse_qs, urljoin
 
-import requests
-from geopy.geocoders import GoogleV3
-from condconf import CondMeta, cond_func_generator
+from transitions import Transition
 from linebot.models import (
     TextSendMessage, ImageSendMessage, LocationSendMessage,
     TemplateSendMessage, ImagemapSendMessage, BaseSize, ImagemapArea, CarouselTemplate,
@@ -19,12 +20,19 @@ from ..models import (
     UnrecognizedMsg, MessageLog, BotReplyLog, ResponseToUnrecogMsg, ReportZapperMsg
 )
 from .botfsm import BotGraphMachine, LineBotEventConditionMixin
+from .condition_matcher import ConditionMatcher
 from .decorators import log_fsm_condition, log_fsm_operation
+from .dispatch_index import IndexedEvent
+from .static_reply import StaticReply, reply_log_content
+from .template_registry import TemplateRegistry
 from .constants import (
     SYMPTOM_PREVIEW_URL, SYMPTOM_ORIGIN_URL, KNOWLEDGE_URL, QA_URL, ZAPPER_IMGMAP_URL,
     LOC_STEP1_PREVIEW_URL, LOC_STEP1_ORIGIN_URL, LOC_STEP2_PREVIEW_URL, LOC_STEP2_ORIGIN_URL,
     BASE_ZAPPER_API_URL
 )
+from ..geocoding import geocoder
+from ..log_writer import log_writer
+from ..transport import transport
 from ..utils import get_web_info, get_web_screenshot
 
 
@@ -45,6 +53,11 @@ class DengueBotMachine(BotGraphMachine, LineBotEventConditionMixin):
     SUPPORTED_LANGUAGES = {
         '1': 'zh_tw',
     }
+    HOSPITAL_REPLY_CACHE_SIZE = 1000
+    # Replies that are the same for every user, built by _<name>_messages
+    STATIC_REPLIES = (
+        'ask_dengue_fever', 'ask_symptom', 'ask_prevention', 'ask_epidemic', 'ask_hospital',
+    )
 
     def __init__(self, states, transitions, initial_state='user', *,
                  bot_client, template_path, external_modules=None):
@@ -52,32 +65,91 @@ class DengueBotMachine(BotGraphMachine, LineBotEventConditionMixin):
             states, transitions, initial_state,
             bot_client=bot_client, template_path=template_path, external_modules=external_modules
         )
+        # Satisfied conditions of each message, filled by the condition matcher
+        self._condition_bits = dict()
+        self.build_dispatch_index()
+
+        self.template_registry = TemplateRegistry(template_path)
+        self.template_registry.prerender(super().render_text)
+        self.static_replies = {
+            name: StaticReply(getattr(self, '_{}_messages'.format(name))())
+            for name in self.STATIC_REPLIES
+        }
+        # Nearby hospital carousels by the hospitals in them, shared by the cursors
+        self._hospital_replies = OrderedDict()
+        self._hospital_replies_lock = threading.Lock()
+
+    @staticmethod
+    def _create_transition(*args, **kwargs):
+        # Transitions must not paint the graph since all the cursors share it
+        return Transition(*args, **kwargs)
+
+    @staticmethod
+    def _create_event(*args, **kwargs):
+        return IndexedEvent(*args, **kwargs)
+
+    def render_text(self, template, *args, **kwargs):
+        # Constant templates skip Jinja, see TemplateRegistry
+        text = self.template_registry.get_text(template)
+        if text is None:
+            text = super().render_text(template, *args, **kwargs)
+        return text
+
+    def build_dispatch_index(self):
+        """Index the transitions of every trigger by (source state, event kind)."""
+        for event in self.events.values():
+            event.build_dispatch_index()
+
+    def spawn(self, state=None):
+        """Create a cursor of this machine that stands on ``state``.
+
+        The cursor shares states, transitions and condition functions with
+        this machine but owns its current state. Give every event its own
+        cursor so that concurrent events never move each other's state.
+
+        Args:
+            state (str): state of the cursor, defaults to the initial state
+
+        Returns:
+            DengueBotMachine: the cursor
+        """
+        cursor = object.__new__(type(self))
+        cursor.__dict__.update(self.__dict__)
+        cursor.models = [cursor]
+        cursor._condition_bits = dict()
+        cursor._condition_memo = None
+        # Triggers and custom callbacks are bound to this machine as its own model
+        for name, attr in self.__dict__.items():
+            if isinstance(attr, (partial, MethodType)):
+                cursor.__dict__[name] = _rebind(attr, self, cursor)
+        cursor.set_state(state or self.initial)
+        return cursor
 
     def reply_message_with_logging(self, event, messages):
-        receiver_id = event.source.user_id
-
-        def save_message(msg):
-            try:
-                content = msg.text
-            except AttributeError:
-                content = '===This is {message_type} type message.==='.format(
-                    message_type=msg.type
-                )
-
-            bot_reply_log = BotReplyLog(
-                receiver=LineUser.objects.get(user_id=receiver_id),
-                speak_time=datetime.now(),
-                message_type=msg.type,
-                content=content
-            )
-            bot_reply_log.save()
-
         self.bot_client.reply_message(event.reply_token, messages)
 
         if not isinstance(messages, (list, tuple)):
             messages = [messages]
         for m in messages:
-            save_message(m)
+            self._log_reply(event, m.type, reply_log_content(m))
+
+    def reply_static_with_logging(self, event, name):
+        """Reply the pre-serialized messages of the static reply ``name``."""
+        self._reply_serialized(event, self.static_replies[name])
+
+    def _reply_serialized(self, event, static_reply):
+        self.bot_client.reply_static(event.reply_token, static_reply)
+
+        for message_type, content in static_reply.log_fields:
+            self._log_reply(event, message_type, content)
+
+    def _log_reply(self, event, message_type, content):
+        log_writer.add(BotReplyLog(
+            receiver_id=event.source.user_id,
+            speak_time=datetime.now(),
+            message_type=message_type,
+            content=content
+        ))
 
     # -FSM conditions-
     @log_fsm_condition
@@ -125,16 +197,16 @@ class DengueBotMachine(BotGraphMachine, LineBotEventConditionMixin):
     def is_hospital_address(self, event):
         return 'hosptial_address' in parse_qs(event.postback.data)
 
-    @log_fsm_operation
+    @log_fsm_condition
     def is_gov_report(self, event):
         return '#2016' in event.message.text
 
-    @log_fsm_operation
+    @log_fsm_condition
     def is_valid_language(self, event):
         text = event.message.text
         return text in self.SUPPORTED_LANGUAGES or text.lower() in self.SUPPORTED_LANGUAGES.values()
 
-    @log_fsm_operation
+    @log_fsm_condition
     def is_invalid_language(self, event):
         return not self.is_valid_language(event)
 
@@ -160,11 +232,28 @@ class DengueBotMachine(BotGraphMachine, LineBotEventConditionMixin):
 
     def _send_hospital_msgs(self, hospital_list, event):
         if hospital_list:
-            msgs = self._create_hospitals_msgs(hospital_list)
+            self._reply_serialized(event, self._hospital_reply(hospital_list))
         else:
             msgs = TextSendMessage(text=self.render_text('nearby_hospital/no_nearby_hospital.j2'))
-
-        self.reply_message_with_logging(event, msgs)
+            self.reply_message_with_logging(event, msgs)
+
+    def _hospital_reply(self, hospital_list):
+        # Neighbours get the same hospitals, so their carousels are serialized once
+        key = tuple((hospital.get('name'), hospital.get('address'), hospital.get('phone'))
+                    for hospital in hospital_list)
+        hospital_replies = self._hospital_replies
+        with self._hospital_replies_lock:
+            static_reply = hospital_replies.get(key)
+            if static_reply is not None:
+                hospital_replies.move_to_end(key)
+                return static_reply
+
+        static_reply = StaticReply(self._create_hospitals_msgs(hospital_list))
+        with self._hospital_replies_lock:
+            hospital_replies[key] = static_reply
+            if len(hospital_replies) > self.HOSPITAL_REPLY_CACHE_SIZE:
+                hospital_replies.popitem(last=False)
+        return static_reply
 
     def _create_hospitals_msgs(self, hospital_list):
         carousel_messages = list()
@@ -231,7 +320,7 @@ class DengueBotMachine(BotGraphMachine, LineBotEventConditionMixin):
             ]
         )
         try:
-            line_user = LineUser.objects.get(user_id=event.source.user_id)
+            line_user = LineUser.objects.get_cached(event.source.user_id)
         except LineUser.DoesNotExist:
             logger.error('Line User Does Not Exist')
         else:
@@ -279,7 +368,7 @@ class DengueBotMachine(BotGraphMachine, LineBotEventConditionMixin):
 
     def _send_zapper_cond_img(self, event, mode):
         try:
-            line_user = LineUser.objects.get(user_id=event.source.user_id)
+            line_user = LineUser.objects.get_cached(event.source.user_id)
         except LineUser.DoesNotExist:
             logger.error('Line User Does Not Exist')
         else:
@@ -301,7 +390,7 @@ class DengueBotMachine(BotGraphMachine, LineBotEventConditionMixin):
     def on_enter_user_join(self, event):
         user_id = event.source.user_id
         profile = self.bot_client.get_profile(user_id)
-        user, created = LineUser.objects.get_or_create(user_id=profile.user_id)
+        user, created = LineUser.objects.get_or_create_cached(profile.user_id)
         user.name = profile.display_name
         user.picture_url = profile.picture_url or ''
         user.status_message = profile.status_message or ''
@@ -318,7 +407,7 @@ class DengueBotMachine(BotGraphMachine, LineBotEventConditionMixin):
             language = language_choice
 
         user_id = event.source.user_id
-        user, created = LineUser.objects.get_or_create(user_id=user_id)
+        user, created = LineUser.objects.get_or_create_cached(user_id)
         user.language = language
         user.save()
 
@@ -332,6 +421,8 @@ class DengueBotMachine(BotGraphMachine, LineBotEventConditionMixin):
     @log_fsm_operation
     def on_enter_unrecognized_msg(self, event):
         if getattr(event, 'reply_token', None):
+            # The log of this message may still be buffered
+            log_writer.flush()
             msg_log = MessageLog.objects.get(
                 speaker=event.source.user_id,
                 speak_time=datetime.fromtimestamp(event.timestamp/1000),
@@ -354,82 +445,82 @@ class DengueBotMachine(BotGraphMachine, LineBotEventConditionMixin):
                 )
         self.handle_unrecognized_msg(event)
 
-    @log_fsm_operation
-    def on_enter_ask_dengue_fever(self, event):
-        self.reply_message_with_logging(
-            event,
-            messages=TemplateSendMessage(
-                alt_text=self.render_text(
-                    'denguefever_intro/alt_text.j2',
-                    {
-                        'knowledge_url': KNOWLEDGE_URL,
-                        'qa_url': QA_URL
-                    }
-                ),
-                template=ButtonsTemplate(
-                    text=self.render_text('denguefever_intro/intro_head.j2', {'is_button': True}),
-                    actions=[
-                        URITemplateAction(
-                            label=self.render_text('denguefever_intro/intro_label.j2'),
-                            uri=KNOWLEDGE_URL
-                        ),
-                        URITemplateAction(
-                            label=self.render_text('denguefever_intro/qa_label.j2'),
-                            uri=QA_URL
-                        )
-                    ]
-                )
+    def _ask_dengue_fever_messages(self):
+        return TemplateSendMessage(
+            alt_text=self.render_text(
+                'denguefever_intro/alt_text.j2',
+                {
+                    'knowledge_url': KNOWLEDGE_URL,
+                    'qa_url': QA_URL
+                }
+            ),
+            template=ButtonsTemplate(
+                text=self.render_text('denguefever_intro/intro_head.j2', {'is_button': True}),
+                actions=[
+                    URITemplateAction(
+                        label=self.render_text('denguefever_intro/intro_label.j2'),
+                        uri=KNOWLEDGE_URL
+                    ),
+                    URITemplateAction(
+                        label=self.render_text('denguefever_intro/qa_label.j2'),
+                        uri=QA_URL
+                    )
+                ]
             )
         )
+
+    @log_fsm_operation
+    def on_enter_ask_dengue_fever(self, event):
+        self.reply_static_with_logging(event, 'ask_dengue_fever')
         self.finish_ans()
 
+    def _ask_symptom_messages(self):
+        return [
+            ImageSendMessage(
+                original_content_url=SYMPTOM_ORIGIN_URL,
+                preview_image_url=SYMPTOM_PREVIEW_URL
+            ),
+            TextSendMessage(text=self.render_text('symptom_warning.j2'))
+        ]
+
     @log_fsm_operation
     def on_enter_ask_symptom(self, event):
-        self.reply_message_with_logging(
-            event,
-            messages=[
-                ImageSendMessage(
-                    original_content_url=SYMPTOM_ORIGIN_URL,
-                    preview_image_url=SYMPTOM_PREVIEW_URL
-                ),
-                TextSendMessage(text=self.render_text('symptom_warning.j2'))
-            ]
-        )
+        self.reply_static_with_logging(event, 'ask_symptom')
         self.finish_ans()
 
-    @log_fsm_operation
-    def on_enter_ask_prevention(self, event):
+    def _ask_prevention_messages(self):
         text = self.render_text('ask_prevent_type.j2')
-        self.reply_message_with_logging(
-            event,
-            TemplateSendMessage(
-                alt_text=text,
-                template=ButtonsTemplate(
-                    text=text,
-                    actions=[
-                        PostbackTemplateAction(
-                            label=self.render_text('label/self_label.j2'),
-                            data='自身'
-                        ),
-                        PostbackTemplateAction(
-                            label=self.render_text('label/env_label.j2'),
-                            data='環境'
-                        ),
-                    ]
-                )
+        return TemplateSendMessage(
+            alt_text=text,
+            template=ButtonsTemplate(
+                text=text,
+                actions=[
+                    PostbackTemplateAction(
+                        label=self.render_text('label/self_label.j2'),
+                        data='自身'
+                    ),
+                    PostbackTemplateAction(
+                        label=self.render_text('label/env_label.j2'),
+                        data='環境'
+                    ),
+                ]
             )
         )
 
     @log_fsm_operation
-    def on_enter_ask_hospital(self, event):
+    def on_enter_ask_prevention(self, event):
+        self.reply_static_with_logging(event, 'ask_prevention')
+
+    def _ask_hospital_messages(self):
         messages = [
             TextSendMessage(text=self.render_text('ask_address.j2'))
         ]
         messages.extend(self.LOCATION_SEND_TUTOIRAL_MSG)
-        self.reply_message_with_logging(
-            event,
-            messages=messages
-        )
+        return messages
+
+    @log_fsm_operation
+    def on_enter_ask_hospital(self, event):
+        self.reply_static_with_logging(event, 'ask_hospital')
         self.advance()
 
     @log_fsm_operation
@@ -439,13 +530,11 @@ class DengueBotMachine(BotGraphMachine, LineBotEventConditionMixin):
         self._send_hospital_msgs(hospital_list, event)
         self.finish_ans()
 
-    @log_fsm_condition
+    @log_fsm_operation
     def on_enter_receive_user_address(self, event):
-        coder = GoogleV3()
-        address = event.message.text
-        geocode = coder.geocode(address)
-        if geocode:
-            hospital_list = hospital.utils.get_nearby_hospital(geocode.longitude, geocode.latitude)
+        location = geocoder.geocode(event.message.text)
+        if location:
+            hospital_list = hospital.utils.get_nearby_hospital(*location)
             self._send_hospital_msgs(hospital_list, event)
             self.finish_ans()
         else:
@@ -468,31 +557,31 @@ class DengueBotMachine(BotGraphMachine, LineBotEventConditionMixin):
         )
         self.finish_ans()
 
-    @log_fsm_operation
-    def on_enter_ask_epidemic(self, event):
+    def _ask_epidemic_messages(self):
         EPIDEMIC_LINK = 'http://www.denguefever.tw/realTime'
-        self.reply_message_with_logging(
-            event,
-            messages=TemplateSendMessage(
-                alt_text=self.render_text('new_condition.j2', {'link': EPIDEMIC_LINK}),
-                template=ButtonsTemplate(
-                    text=self.render_text('new_condition.j2'),
-                    actions=[
-                        URITemplateAction(
-                            label='Link',
-                            uri=EPIDEMIC_LINK
-                        )
-                    ]
-                )
+        return TemplateSendMessage(
+            alt_text=self.render_text('new_condition.j2', {'link': EPIDEMIC_LINK}),
+            template=ButtonsTemplate(
+                text=self.render_text('new_condition.j2'),
+                actions=[
+                    URITemplateAction(
+                        label='Link',
+                        uri=EPIDEMIC_LINK
+                    )
+                ]
             )
         )
+
+    @log_fsm_operation
+    def on_enter_ask_epidemic(self, event):
+        self.reply_static_with_logging(event, 'ask_epidemic')
         self.finish_ans()
 
     @log_fsm_operation
     def on_exit_wait_user_suggestion(self, event):
         self._send_template_text(event, 'thank_advice.j2')
         advice = Suggestion(content=event.message.text,
-                            user=LineUser.objects.get(user_id=event.source.user_id))
+                            user=LineUser.objects.get_cached(event.source.user_id))
         advice.save()
 
     @log_fsm_operation
@@ -501,7 +590,7 @@ class DengueBotMachine(BotGraphMachine, LineBotEventConditionMixin):
         _, _, action, note = text.split('#')
 
         gov_report = GovReport(
-            user=LineUser.objects.get(user_id=event.source.user_id),
+            user=LineUser.objects.get_cached(event.source.user_id),
             action=action,
             note=note,
             report_time=datetime.fromtimestamp(event.timestamp/1000),
@@ -522,7 +611,7 @@ class DengueBotMachine(BotGraphMachine, LineBotEventConditionMixin):
     def on_enter_receive_gov_location(self, event):
         try:
             gov_report = GovReport.objects.filter(
-                user=LineUser.objects.get(user_id=event.source.user_id),
+                user=LineUser.objects.get_cached(event.source.user_id),
             ).order_by('-report_time')[0]
         except GovReport.DoesNotExist:
             logger.error('Gov Report Does Not Exist')
@@ -552,7 +641,7 @@ class DengueBotMachine(BotGraphMachine, LineBotEventConditionMixin):
     @log_fsm_operation
     def on_enter_receive_register_location(self, event):
         try:
-            line_user = LineUser.objects.get(user_id=event.source.user_id)
+            line_user = LineUser.objects.get_cached(event.source.user_id)
         except LineUser.DoesNotExist:
             logger.error('Line User Does Not Exist')
         else:
@@ -577,10 +666,10 @@ class DengueBotMachine(BotGraphMachine, LineBotEventConditionMixin):
     @log_fsm_operation
     def on_enter_receive_zapper_id(self, event):
         zapper_api = urljoin(BASE_ZAPPER_API_URL, 'lamps/{id}?key=hash'.format(id=event.message.text))
-        response = requests.get(zapper_api)
+        response = transport.get(zapper_api)
         if response.status_code == 200:
             try:
-                line_user = LineUser.objects.get(user_id=event.source.user_id)
+                line_user = LineUser.objects.get_cached(event.source.user_id)
             except LineUser.DoesNotExist:
                 logger.error('Line User Does Not Exist')
             else:
@@ -603,13 +692,13 @@ class DengueBotMachine(BotGraphMachine, LineBotEventConditionMixin):
     def on_enter_receive_zapper_problem(self, event):
         self._send_template_text(event, 'thank_zapper_report.j2')
         try:
-            line_user = LineUser.objects.get(user_id=event.source.user_id)
+            line_user = LineUser.objects.get_cached(event.source.user_id)
         except LineUser.DoesNotExist:
             logger.error('Line User Does Not Exist')
         else:
             payload = {'lamp_id': line_user.zapper_id, 'comment_content': event.message.text}
             zapper_api = urljoin(BASE_ZAPPER_API_URL, 'comments')
-            requests.post(url=zapper_api, data=payload)
+            transport.post(zapper_api, data=payload)
 
             report = ReportZapperMsg(
                 reporter=line_user,
@@ -646,13 +735,27 @@ class DengueBotMachine(BotGraphMachine, LineBotEventConditionMixin):
         self.finish_ans()
 
 
+def _rebind(func, old_self, new_self):
+    if isinstance(func, partial):
+        args = tuple(new_self if arg is old_self else arg for arg in func.args)
+        return partial(_rebind(func.func, old_self, new_self), *args, **func.keywords)
+    if isinstance(func, MethodType) and func.__self__ is old_self:
+        return MethodType(func.__func__, new_self)
+    return func
+
+
 def generate_fsm_cls(cls_name, condition_config,
-                     *, template_args=None, external_globals=None, cond_var_name=None):
-    """Generate FSM class through condition config."""
+                     *, template_args=None, external_globals=None, cond_var_name=None,
+                     automaton=None):
+    """Generate FSM class through condition config.
+
+    All the conditions are compiled into one ConditionMatcher, so a message
+    is scanned once no matter how many conditions the FSM checks. A keyword
+    automaton loaded from the FSM config cache can be passed as ``automaton``.
+    """
     if not template_args:
         template_args = {
             'decorators': ['log_fsm_condition'],
-            'func_args': ['self', 'event'],
             'preprocess_code': ['msg = event.message.text']
         }
     if not external_globals:
@@ -660,10 +763,16 @@ def generate_fsm_cls(cls_name, condition_config,
             'log_fsm_condition': log_fsm_condition
         }
 
-    cond_funcs = cond_func_generator(
+    condition_matcher = ConditionMatcher(
         condition_config,
-        template_args=template_args,
-        cond_var_name=cond_var_name or 'msg'
+        preprocess_code=template_args.get('preprocess_code'),
+        cond_var_name=cond_var_name or 'msg',
+        automaton=automaton
     )
-    return CondMeta(cls_name, (DengueBotMachine,), dict(),
-                    cond_funcs=cond_funcs, external_globals=external_globals)
+    cond_funcs = {'condition_matcher': condition_matcher}
+    for name in condition_matcher.condition_names:
+        cond_func = condition_matcher.condition_method(name)
+        for decorator in reversed(template_args.get('decorators', [])):
+            cond_func = external_globals[decorator](cond_func)
+        cond_funcs[name] = cond_func
+    return type(cls_name, (DengueBotMachine,), cond_funcs)
@@ -0,0 +1,98 @@
+import copy
+import logging
+
+from linebot.models import MessageEvent
+from transitions.core import Event, EventData
+
+
+logger = logging.getLogger(__name__)
+
+# Conditions decided by the kind of the Line event alone
+EVENT_KIND_CONDITIONS = {
+    'is_text_message': 'text',
+    'is_location_message': 'location',
+    'is_postback_event': 'postback',
+    'is_follow_event': 'follow',
+}
+EVENT_KINDS = (
+    'text', 'image', 'video', 'audio', 'file', 'location', 'sticker',
+    'follow', 'unfollow', 'join', 'leave', 'postback', 'beacon',
+)
+
+
+def event_kind(event):
+    """Kind of a Line event, the message type for message events and the event type for others."""
+    if isinstance(event, MessageEvent):
+        return event.message.type
+    return getattr(event, 'type', None)
+
+
+class IndexedEvent(Event):
+    """Trigger that only tries the transitions that can fire for the kind of the Line event.
+
+    ``build_dispatch_index`` precomputes, for every source state and event
+    kind, the ordered transitions whose event kind conditions are satisfied.
+    Those conditions are dropped from the indexed transitions since they are
+    already decided. Triggers without a Line event (e.g., ``self.advance()`` in
+    a handler) fall back to trying every transition of the state.
+
+    Condition results are memoized on the model for the duration of a trigger
+    (see ``log_fsm_condition``), so each condition is evaluated once however
+    many transitions test it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dispatch_index = None
+
+    def build_dispatch_index(self):
+        dispatch_index = dict()
+        for source, transitions in self.transitions.items():
+            for kind in EVENT_KINDS:
+                dispatch_index[(source, kind)] = [
+                    self._prune(transition) for transition in transitions
+                    if self._can_fire(transition, kind)
+                ]
+        self.dispatch_index = dispatch_index
+
+    def _trigger(self, model, *args, **kwargs):
+        previous_memo = model.__dict__.get('_condition_memo')
+        model._condition_memo = dict()
+        try:
+            return self._trigger_indexed(model, *args, **kwargs)
+        finally:
+            logger.debug('Condition memo of %s (now in %s)\n%s\n',
+                         self.name, model.state, model._condition_memo)
+            model._condition_memo = previous_memo
+
+    def _trigger_indexed(self, model, *args, **kwargs):
+        transitions = None
+        if self.dispatch_index is not None and args:
+            transitions = self.dispatch_index.get((model.state, event_kind(args[0])))
+        if transitions is None:
+            return super()._trigger(model, *args, **kwargs)
+
+        event_data = EventData(self.machine.get_state(model.state), self, self.machine, model,
+                               args=args, kwargs=kwargs)
+        for transition in transitions:
+            event_data.transition = transition
+            if transition.execute(event_data):
+                return True
+        return False
+
+    @staticmethod
+    def _can_fire(transition, kind):
+        return all(
+            (EVENT_KIND_CONDITIONS[condition.func] == kind) == condition.target
+            for condition in transition.conditions
+            if condition.func in EVENT_KIND_CONDITIONS
+        )
+
+    @staticmethod
+    def _prune(transition):
+        pruned_transition = copy.copy(transition)
+        pruned_transition.conditions = [
+            condition for condition in transition.conditions
+            if condition.func not in EVENT_KIND_CONDITIONS
+        ]
+        return pruned_transition
@@ -0,0 +1,51 @@
+import json
+
+from linebot import LineBotApi
+
+
+REPLY_PATH = '/v2/bot/message/reply'
+
+
+def reply_log_content(message):
+    """Content of a message to be saved in BotReplyLog."""
+    try:
+        return message.text
+    except AttributeError:
+        return '===This is {message_type} type message.==='.format(
+            message_type=message.type
+        )
+
+
+class StaticReply:
+    """Reply messages that are the same for every user, serialized once.
+
+    Only the reply token differs between two replies, so the request body is
+    the pre-serialized messages wrapped with the token.
+
+    Args:
+        messages (Union[linebot.models.SendMessage, List[linebot.models.SendMessage]]): messages to reply
+
+    Attributes:
+        log_fields (List[Tuple[str, str]]): message type and content of each message for BotReplyLog
+    """
+
+    def __init__(self, messages):
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        self.messages_json = json.dumps([message.as_json_dict() for message in messages])
+        self.log_fields = [(message.type, reply_log_content(message)) for message in messages]
+
+    def body(self, reply_token):
+        return '{{"replyToken": {}, "messages": {}}}'.format(json.dumps(reply_token), self.messages_json)
+
+
+class StaticReplyLineBotApi(LineBotApi):
+    """LineBotApi that can also reply a StaticReply without serializing its messages again.
+
+    ``reply_static`` posts through ``LineBotApi._post``, which is private to
+    line-bot-sdk (pinned to 1.1.0 in Pipfile), so check it whenever the SDK
+    is upgraded.
+    """
+
+    def reply_static(self, reply_token, static_reply, timeout=None):
+        self._post(REPLY_PATH, data=static_reply.body(reply_token), timeout=timeout)
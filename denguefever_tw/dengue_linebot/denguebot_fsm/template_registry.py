@@ -0,0 +1,78 @@
+import logging
+import os
+
+from jinja2 import Environment, meta
+
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_EXTENSION = '.j2'
+
+
+class TemplateRegistry:
+    """Registry of the bot templates of a language.
+
+    Every template under ``template_path`` is parsed when the FSM is built and
+    marked as constant if neither it nor any template it includes, imports or
+    extends refers to a variable. The output of a constant template never
+    changes, so it is rendered once by ``prerender`` and then served as a
+    string.
+
+    Args:
+        template_path (str): directory of the bot templates of a language
+
+    Attributes:
+        constant_templates (Set[str]): names of the templates without variables
+        parameterized_templates (Set[str]): names of the other templates
+    """
+
+    def __init__(self, template_path):
+        self.template_path = template_path
+        self._texts = dict()
+
+        env = Environment()
+        self._asts = dict()
+        for root, _, file_names in os.walk(template_path):
+            for file_name in file_names:
+                if not file_name.endswith(TEMPLATE_EXTENSION):
+                    continue
+                path = os.path.join(root, file_name)
+                name = os.path.relpath(path, template_path).replace(os.sep, '/')
+                with open(path, encoding='utf-8') as template_file:
+                    self._asts[name] = env.parse(template_file.read())
+
+        self._constants = dict()
+        self.constant_templates = {name for name in self._asts if self._is_constant(name)}
+        self.parameterized_templates = set(self._asts) - self.constant_templates
+
+    def prerender(self, render):
+        """Render the constant templates through ``render(name)`` and keep their outputs."""
+        for name in sorted(self.constant_templates):
+            try:
+                self._texts[name] = render(name)
+            except Exception as e:
+                logger.warning('Fail to prerender %s.\n %s', name, str(e))
+
+    def get_text(self, name):
+        """Output of a constant template, None if it is not prerendered."""
+        return self._texts.get(name)
+
+    def _is_constant(self, name, visiting=None):
+        if name in self._constants:
+            return self._constants[name]
+        ast = self._asts.get(name)
+        if ast is None:
+            return False
+
+        visiting = visiting or set()
+        if name in visiting:
+            # Recursive templates are left to Jinja
+            return False
+        visiting.add(name)
+
+        is_constant = not meta.find_undeclared_variables(ast) and all(
+            referenced is not None and self._is_constant(referenced, visiting)
+            for referenced in meta.find_referenced_templates(ast)
+        )
+        self._constants[name] = is_constant
+        return is_constant
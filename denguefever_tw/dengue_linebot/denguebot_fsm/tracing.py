@@ -0,0 +1,111 @@
+from django.conf import settings
+
+import random
+import threading
+from collections import deque
+from contextlib import contextmanager
+from time import perf_counter, time
+
+from .dispatch_index import event_kind
+
+
+# Field names of an exported span, see FSMSpan.export
+SPAN_FIELDS = (
+    'time', 'user_id', 'event_kind', 'state', 'end_state', 'ms', 'error',
+    'conditions', 'operations',
+)
+
+_local = threading.local()
+
+
+def current_span():
+    """Span of the event being handled by this thread, None if it is not sampled."""
+    return getattr(_local, 'span', None)
+
+
+class FSMSpan:
+    """Trace of how the FSM advanced on one Line event.
+
+    Attributes:
+        conditions (List[Tuple[str, bool]]): conditions tried and their results in order
+        operations (List[Tuple[str, str, str, float]]): handlers run, with the states
+            before and after, and their duration in milliseconds
+    """
+
+    __slots__ = (
+        'time', 'user_id', 'event_kind', 'state', 'end_state', 'duration', 'error',
+        'conditions', 'operations',
+    )
+
+    def __init__(self, user_id, kind, state):
+        self.time = time()
+        self.user_id = user_id
+        self.event_kind = kind
+        self.state = state
+        self.end_state = None
+        self.duration = None
+        self.error = None
+        self.conditions = list()
+        self.operations = list()
+
+    def export(self):
+        """Compact form of the span, a list in the order of SPAN_FIELDS."""
+        return [
+            round(self.time, 3), self.user_id, self.event_kind, self.state, self.end_state,
+            round(self.duration * 1000, 3), self.error,
+            [[name, int(result)] for name, result in self.conditions],
+            [[name, pre_state, post_state, round(ms, 3)]
+             for name, pre_state, post_state, ms in self.operations],
+        ]
+
+
+class FSMTracer:
+    """Record spans of a sample of the handled events into a ring buffer.
+
+    Events that are not sampled cost one random number, and the FSM
+    decorators skip recording as soon as they find no current span.
+
+    Args:
+        sample_rate (float): fraction of events to trace, 0 to disable tracing
+        buffer_size (int): number of latest spans to keep
+    """
+
+    def __init__(self, sample_rate, buffer_size):
+        self.sample_rate = sample_rate
+        self._spans = deque(maxlen=buffer_size)
+
+    @contextmanager
+    def trace(self, machine, event):
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            yield None
+            return
+
+        span = FSMSpan(event.source.user_id, event_kind(event), machine.state)
+        previous_span, _local.span = current_span(), span
+        start = perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.duration = perf_counter() - start
+            span.end_state = machine.state
+            _local.span = previous_span
+            self._spans.append(span)
+
+    def export(self, limit=None):
+        """Latest spans in compact form, the newest last."""
+        spans = list(self._spans)
+        if limit:
+            spans = spans[-limit:]
+        return {
+            'fields': SPAN_FIELDS,
+            'spans': [span.export() for span in spans],
+        }
+
+
+fsm_tracer = FSMTracer(
+    sample_rate=settings.DENGUE_BOT_FSM_TRACE_SAMPLE_RATE,
+    buffer_size=settings.DENGUE_BOT_FSM_TRACE_BUFFER_SIZE,
+)
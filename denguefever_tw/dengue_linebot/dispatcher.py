@@ -0,0 +1,105 @@
+from django.db import close_old_connections
+
+import logging
+import threading
+import zlib
+from concurrent.futures import Future
+from queue import Queue
+
+
+logger = logging.getLogger('django')
+
+
+class EventDispatcher:
+    """Dispatch Line events to a pool of shard threads.
+
+    Events are sharded by the user id of their source. Each shard is served by
+    a single thread, so the events of one user are handled in the order they
+    are dispatched while events of different users run in parallel.
+
+    Args:
+        shard_count (int): number of shard threads
+        handler (Callable[[linebot.models.Event], Any]): default function that handles an event
+
+    Examples:
+        >>> dispatcher = EventDispatcher(shard_count=4, handler=handle_event)
+        >>> futures = dispatcher.dispatch(events)
+        >>> concurrent.futures.wait(futures)
+    """
+
+    def __init__(self, shard_count, handler=None):
+        self.handler = handler
+        self.shard_count = shard_count
+        self._queues = [Queue() for _ in range(shard_count)]
+        self._processed = [0] * shard_count
+        self._max_depths = [0] * shard_count
+        self._threads = [
+            threading.Thread(target=self._work, args=(shard,),
+                             name='event-shard-{}'.format(shard), daemon=True)
+            for shard in range(shard_count)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def shard_of(self, user_id):
+        return zlib.crc32(user_id.encode('utf-8')) % self.shard_count
+
+    def dispatch(self, events, handler=None):
+        """Put events on the queues of their shards.
+
+        Args:
+            events (List[linebot.models.Event]): events in the order they should be handled
+            handler (Callable[[linebot.models.Event], Any]): handle these events
+                instead of the handler of the dispatcher
+
+        Returns:
+            List[concurrent.futures.Future]: futures of the events in the given order
+        """
+        futures = list()
+        for event in events:
+            future = Future()
+            shard = self.shard_of(event.source.user_id)
+            shard_queue = self._queues[shard]
+            shard_queue.put((event, handler or self.handler, future))
+            self._max_depths[shard] = max(self._max_depths[shard], shard_queue.qsize())
+            futures.append(future)
+        return futures
+
+    def stop(self):
+        for shard_queue in self._queues:
+            shard_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        """Queue depth metrics of each shard.
+
+        Returns:
+            List[dict]: current depth, max depth and processed count of each shard
+        """
+        return [
+            {
+                'shard': shard,
+                'depth': shard_queue.qsize(),
+                'max_depth': self._max_depths[shard],
+                'processed': self._processed[shard],
+            }
+            for shard, shard_queue in enumerate(self._queues)
+        ]
+
+    def _work(self, shard):
+        shard_queue = self._queues[shard]
+        while True:
+            item = shard_queue.get()
+            if item is None:
+                break
+
+            event, handler, future = item
+            if future.set_running_or_notify_cancel():
+                close_old_connections()
+                try:
+                    future.set_result(handler(event))
+                except Exception as e:
+                    logger.exception('Exception occurs in shard %s.\n %s', shard, str(e))
+                    future.set_exception(e)
+            self._processed[shard] += 1
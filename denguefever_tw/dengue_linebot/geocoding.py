@@ -0,0 +1,164 @@
+from django.conf import settings
+from django.db.utils import IntegrityError
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+import logging
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from time import monotonic
+
+from geopy.exc import GeopyError
+from geopy.geocoders import GoogleV3
+
+from .models import GeocodeCache
+
+
+# Seconds before an address whose backend failed is tried again
+ERROR_TTL = 60
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+logger = logging.getLogger('django')
+
+
+class GeocodingError(Exception):
+    """The backend fails to answer, e.g., timeout or quota exceeded."""
+
+
+def normalize_address(address):
+    """Fold the variants of an address into one key.
+
+    Full-width characters are folded into half-width ones, 台 into 臺 and
+    whitespace is removed.
+    """
+    address = unicodedata.normalize('NFKC', address).replace('台', '臺')
+    return WHITESPACE_PATTERN.sub('', address)
+
+
+class GoogleV3Backend:
+    """Geocode with Google Maps API."""
+
+    def __init__(self, api_key=None, timeout=None):
+        self.coder = GoogleV3(api_key=api_key,
+                              timeout=timeout or settings.DENGUE_BOT_HTTP_READ_TIMEOUT)
+
+    def geocode(self, address):
+        """Longitude and latitude of an address, None if it is not found."""
+        try:
+            location = self.coder.geocode(address)
+        except GeopyError as e:
+            raise GeocodingError(str(e)) from e
+        return (location.longitude, location.latitude) if location else None
+
+
+class StaticBackend:
+    """Geocode with a fixed table of addresses, e.g., for tests and local development.
+
+    Args:
+        addresses (Dict[str, Tuple[float, float]]): longitude and latitude of each address
+    """
+
+    def __init__(self, addresses=None):
+        self.addresses = {
+            normalize_address(address): tuple(location)
+            for address, location in (addresses or dict()).items()
+        }
+
+    def geocode(self, address):
+        return self.addresses.get(normalize_address(address))
+
+
+class Geocoder:
+    """Geocode addresses through a local LRU and a persistent cache.
+
+    Addresses are keyed by ``normalize_address``. A miss of the LRU is looked
+    up in the GeocodeCache table, and a miss of the table is geocoded by the
+    backend and saved. The backend is queried with the address as it is sent,
+    only stripped, since the key is not meant to be readable, e.g., the spaces
+    of addresses in Latin script are removed. Addresses the backend cannot
+    find are cached as well, but looked up again after ``negative_ttl``
+    seconds. Failures of the backend are only held in the LRU for ERROR_TTL
+    seconds.
+
+    Args:
+        backend: object whose ``geocode(address)`` returns longitude and latitude or None
+        cache_size (int): max number of addresses in the LRU
+        negative_ttl (int): seconds an address that is not found stays cached
+
+    Examples:
+        >>> lng, lat = geocoder.geocode('台南市東區大學路1號')
+    """
+
+    def __init__(self, backend, cache_size, negative_ttl):
+        self.backend = backend
+        self.cache_size = cache_size
+        self.negative_ttl = negative_ttl
+        # Normalized address to location (None if not found) and its expire time (None for never)
+        self._addresses = OrderedDict()
+        self._lock = threading.Lock()
+
+    def geocode(self, address):
+        """Longitude and latitude of an address, None if it is not found or the backend fails.
+
+        Returns:
+            Tuple[float, float]: longitude and latitude
+        """
+        address = address.strip()
+        key = normalize_address(address)
+        if not key:
+            return None
+
+        with self._lock:
+            cached = self._addresses.get(key)
+            if cached is not None:
+                self._addresses.move_to_end(key)
+        if cached is not None:
+            location, expire_time = cached
+            if expire_time is None or monotonic() < expire_time:
+                return location
+
+        row = GeocodeCache.objects.filter(address=key).first()
+        if row is not None:
+            if row.is_found():
+                self._remember(key, row.get_location(), None)
+                return row.get_location()
+            ttl = self.negative_ttl - (timezone.now() - row.update_time).total_seconds()
+            if ttl > 0:
+                self._remember(key, None, ttl)
+                return None
+
+        try:
+            location = self.backend.geocode(address)
+        except GeocodingError as e:
+            logger.warning('Fail to geocode %s.\n %s', address, str(e))
+            self._remember(key, None, ERROR_TTL)
+            return None
+        self._save(key, location)
+        self._remember(key, location, None if location else self.negative_ttl)
+        return location
+
+    def _remember(self, key, location, ttl):
+        with self._lock:
+            self._addresses[key] = (location, None if ttl is None else monotonic() + ttl)
+            self._addresses.move_to_end(key)
+            if len(self._addresses) > self.cache_size:
+                self._addresses.popitem(last=False)
+
+    @staticmethod
+    def _save(key, location):
+        lng, lat = location if location else (None, None)
+        try:
+            GeocodeCache.objects.update_or_create(address=key, defaults={'lng': lng, 'lat': lat})
+        except IntegrityError:
+            # Saved by another process at the same time
+            pass
+
+
+geocoder = Geocoder(
+    backend=import_string(settings.DENGUE_BOT_GEOCODER_BACKEND)(**settings.DENGUE_BOT_GEOCODER_OPTIONS),
+    cache_size=settings.DENGUE_BOT_GEOCODE_CACHE_SIZE,
+    negative_ttl=settings.DENGUE_BOT_GEOCODE_NEGATIVE_TTL,
+)
@@ -0,0 +1,135 @@
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.utils import DataError, IntegrityError
+
+import atexit
+import logging
+import threading
+from collections import defaultdict
+
+
+logger = logging.getLogger('django')
+
+
+class BufferedLogWriter:
+    """Buffer log rows in memory and write them with ``bulk_create``.
+
+    Rows are flushed when ``max_rows`` rows are buffered, every
+    ``flush_interval`` milliseconds by a background thread (or at the end of
+    each request if it is 0) and whenever ``flush`` is called. Rows beyond
+    ``buffer_limit`` are dropped so that a broken database can not exhaust
+    the memory of a worker.
+
+    Args:
+        max_rows (int): number of buffered rows that triggers a flush
+        flush_interval (int): milliseconds between two background flushes, 0 to disable the thread
+        buffer_limit (int): max number of buffered rows
+
+    Attributes:
+        dropped_rows (int): rows dropped because the buffer is full
+        failed_rows (int): rows failed to be written to database
+    """
+
+    def __init__(self, max_rows, flush_interval, buffer_limit):
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.buffer_limit = buffer_limit
+        self.dropped_rows = 0
+        self.failed_rows = 0
+        self._rows = list()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = None
+
+    def add(self, row):
+        with self._lock:
+            if self.flush_interval and self._flusher is None:
+                self._start_flusher()
+
+            if len(self._rows) >= self.buffer_limit:
+                self.dropped_rows += 1
+                logger.warning('Log buffer is full. Drop %s', row)
+                return
+            self._rows.append(row)
+            is_full = len(self._rows) >= self.max_rows
+
+        if is_full:
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, list()
+            if not rows:
+                return
+
+            rows_by_model = defaultdict(list)
+            for row in rows:
+                rows_by_model[type(row)].append(row)
+
+            for model, model_rows in rows_by_model.items():
+                try:
+                    with transaction.atomic():
+                        model.objects.bulk_create(model_rows)
+                except (DataError, IntegrityError):
+                    # Find the offending rows one by one so that the others are still written
+                    self._write_one_by_one(model, model_rows)
+                except Exception as e:
+                    self.failed_rows += len(model_rows)
+                    logger.exception('Fail to write %s %s rows.\n %s',
+                                     len(model_rows), model.__name__, str(e))
+
+    def _write_one_by_one(self, model, rows):
+        for row in rows:
+            try:
+                with transaction.atomic():
+                    model.objects.bulk_create([row])
+            except Exception as e:
+                self.failed_rows += 1
+                logger.exception('Fail to write %s %s.\n %s', model.__name__, row, str(e))
+
+    def flush_request(self):
+        """Flush the rows of a finished request unless the background flusher does it."""
+        if not self.flush_interval:
+            self.flush()
+
+    def close(self):
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+
+    def stats(self):
+        return {
+            'buffered_rows': len(self._rows),
+            'dropped_rows': self.dropped_rows,
+            'failed_rows': self.failed_rows,
+        }
+
+    def _start_flusher(self):
+        # Started on first use so that the thread lives in the forked uWSGI worker
+        self._flusher = threading.Thread(target=self._flush_periodically,
+                                         name='log-writer', daemon=True)
+        self._flusher.start()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval / 1000):
+            close_old_connections()
+            self.flush()
+
+
+log_writer = BufferedLogWriter(
+    max_rows=settings.DENGUE_BOT_LOG_FLUSH_ROWS,
+    flush_interval=settings.DENGUE_BOT_LOG_FLUSH_INTERVAL,
+    buffer_limit=settings.DENGUE_BOT_LOG_BUFFER_LIMIT,
+)
+
+atexit.register(log_writer.close)
+
+try:
+    import uwsgi
+except ImportError:
+    pass
+else:
+    uwsgi.atexit = log_writer.close
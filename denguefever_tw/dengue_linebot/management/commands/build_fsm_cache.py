@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+import os
+
+from ...denguebot_fsm.config_cache import config_key, load_fsm_config
+from ...views import CONFIG_PATH, _list_languages
+
+
+class Command(BaseCommand):
+    help = 'Build the FSM config cache of all the languages ahead of deploys'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--clear',
+            action='store_true',
+            help='Remove cached artifacts of config that no longer exists'
+        )
+
+    def handle(self, *args, **options):
+        cache_dir = settings.DENGUE_BOT_FSM_CACHE_DIR
+        if not cache_dir:
+            raise CommandError('DENGUE_BOT_FSM_CACHE_DIR is not set')
+
+        fsm_config_path = os.path.join(CONFIG_PATH, 'FSM.json')
+        artifacts = set()
+        for language in _list_languages():
+            cond_path = os.path.join(CONFIG_PATH, language, 'cond_config.json')
+            load_fsm_config(fsm_config_path, cond_path, cache_dir)
+            key = config_key(fsm_config_path, cond_path)
+            artifacts.add(key + '.pickle')
+            self.stdout.write('{}: {}'.format(language, key))
+
+        if options['clear']:
+            for file_name in os.listdir(cache_dir):
+                if file_name.endswith('.pickle') and file_name not in artifacts:
+                    os.remove(os.path.join(cache_dir, file_name))
+                    self.stdout.write('Removed {}'.format(file_name))
+
+        self.stdout.write('Successfully built')
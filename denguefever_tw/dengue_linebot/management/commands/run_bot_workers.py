@@ -0,0 +1,127 @@
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.core.management.base import BaseCommand
+
+import logging
+from datetime import timedelta
+from time import sleep, monotonic
+
+from ...dispatcher import EventDispatcher
+from ...log_writer import log_writer
+from ...models import WebhookEvent
+from ...transport import transport
+from ...utils import parse_event
+from ...views import handle_events
+
+
+logger = logging.getLogger('django')
+
+
+class Command(BaseCommand):
+    help = 'Process Line webhook events queued by the reply view'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--shards',
+            type=int,
+            default=settings.DENGUE_BOT_EVENT_SHARDS,
+            help='Number of threads that handle events of different users in parallel'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=50
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=0.5,
+            help='Seconds to wait when the queue is empty'
+        )
+        parser.add_argument(
+            '--claim-timeout',
+            type=int,
+            default=300,
+            help='Seconds before an event claimed by a dead worker is processed again'
+        )
+        parser.add_argument(
+            '--stats-interval',
+            type=float,
+            default=60,
+            help='Seconds between two logs of shard queue depths'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Drain the queue and exit'
+        )
+
+    def handle(self, *args, **options):
+        dispatcher = EventDispatcher(options['shards'])
+        self.stdout.write('Start processing queued events with {} shards'.format(options['shards']))
+
+        last_stats_time = monotonic()
+        try:
+            while True:
+                if monotonic() - last_stats_time > options['stats_interval']:
+                    logger.info('Event shard stats\n%s\nLog writer stats\n%s\nHTTP pool stats\n%s',
+                                dispatcher.stats(), log_writer.stats(), transport.stats())
+                    last_stats_time = monotonic()
+
+                try:
+                    queued_events = self.claim_events(options['batch_size'], options['claim_timeout'])
+                    if not queued_events:
+                        if options['once']:
+                            break
+                        sleep(options['poll_interval'])
+                        continue
+                    self.handle_batch(queued_events, dispatcher)
+                except Exception as e:
+                    # Keep the worker alive, events left in the queue are claimed again after the timeout
+                    logger.exception('Fail to process queued events.\n %s', str(e))
+                    close_old_connections()
+                    sleep(options['poll_interval'])
+        finally:
+            dispatcher.stop()
+            log_writer.close()
+
+    @staticmethod
+    def handle_batch(queued_events, dispatcher):
+        events = list()
+        for queued_event in queued_events:
+            try:
+                events.append(parse_event(queued_event.payload))
+            except (KeyError, ValueError):
+                logger.exception('Invalid queued event %s', queued_event.id)
+
+        # Every event is handled (or logged) before it leaves the queue, so that
+        # an event that fails every time can not block the queue
+        try:
+            handle_events(events, dispatcher=dispatcher)
+        except Exception as e:
+            logger.exception('Fail to handle queued events %s. They are dropped.\n %s\n%s',
+                             [queued_event.id for queued_event in queued_events], str(e),
+                             '\n'.join(queued_event.payload for queued_event in queued_events))
+        finally:
+            log_writer.flush_request()
+            WebhookEvent.objects.filter(
+                id__in=[queued_event.id for queued_event in queued_events]
+            ).delete()
+
+    @staticmethod
+    def claim_events(batch_size, claim_timeout):
+        now = timezone.now()
+        with transaction.atomic():
+            queued_events = list(
+                WebhookEvent.objects
+                            .select_for_update(skip_locked=True)
+                            .filter(Q(claim_time__isnull=True) |
+                                    Q(claim_time__lt=now - timedelta(seconds=claim_timeout)))
+                            .order_by('id')[:batch_size]
+            )
+            WebhookEvent.objects.filter(
+                id__in=[queued_event.id for queued_event in queued_events]
+            ).update(claim_time=now)
+        return queued_events
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+
+import logging
+from time import sleep
+
+from ...push_engine import CampaignClaimed, claim_stale_campaign
+from ...views import push_engine
+
+
+logger = logging.getLogger('django')
+
+
+class Command(BaseCommand):
+    help = 'Resume push campaigns whose runner stopped before they were done'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--heartbeat-timeout',
+            type=int,
+            default=300,
+            help='Seconds without progress before a running campaign is resumed'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=30,
+            help='Seconds to wait when no campaign needs to be resumed'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Resume the stale campaigns and exit'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            campaign = claim_stale_campaign(options['heartbeat_timeout'])
+            if campaign is None:
+                if options['once']:
+                    break
+                sleep(options['poll_interval'])
+                continue
+
+            self.stdout.write('Resume push campaign {} ({}/{} users sent)'.format(
+                campaign.id, campaign.sent_users, campaign.total_users
+            ))
+            try:
+                push_engine.run(campaign)
+            except CampaignClaimed:
+                logger.warning('Push campaign %s is claimed by another runner. Stop sending it.', campaign.id)
+            except Exception as e:
+                logger.exception('Fail to resume push campaign %s.\n %s', campaign.id, str(e))
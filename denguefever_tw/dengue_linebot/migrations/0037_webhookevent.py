@@ -0,0 +1,23 @@
+# Generated by Django 2.2.20 on 2026-10-18 08:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dengue_linebot', '0036_auto_20170919_1537'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.TextField(db_index=True)),
+                ('payload', models.TextField()),
+                ('receive_time', models.DateTimeField(auto_now_add=True)),
+                ('claim_time', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 2.2.20 on 2026-10-18 10:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dengue_linebot', '0037_webhookevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushCampaign',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content', models.TextField(blank=True)),
+                ('img', models.TextField(blank=True)),
+                ('create_time', models.DateTimeField(auto_now_add=True)),
+                ('status', models.TextField(default='running')),
+                ('total_users', models.IntegerField(default=0)),
+                ('sent_users', models.IntegerField(default=0)),
+                ('failed_users', models.IntegerField(default=0)),
+                ('heartbeat_time', models.DateTimeField(null=True)),
+                ('finish_time', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PushBatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.IntegerField()),
+                ('user_ids', models.TextField()),
+                ('status', models.TextField(default='pending')),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('send_time', models.DateTimeField(null=True)),
+                ('campaign', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='batches', to='dengue_linebot.PushCampaign')),
+            ],
+            options={
+                'unique_together': {('campaign', 'index')},
+            },
+        ),
+    ]
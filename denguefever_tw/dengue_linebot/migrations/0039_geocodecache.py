@@ -0,0 +1,23 @@
+# Generated by Django 2.2.20 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dengue_linebot', '0038_pushcampaign_pushbatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodeCache',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address', models.TextField(unique=True)),
+                ('lng', models.FloatField(null=True)),
+                ('lat', models.FloatField(null=True)),
+                ('update_time', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.20 on 2026-10-18 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dengue_linebot', '0039_geocodecache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pushcampaign',
+            name='claim_token',
+            field=models.TextField(null=True),
+        ),
+    ]
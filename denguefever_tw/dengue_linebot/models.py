@@ -2,10 +2,58 @@ from django.contrib.gis.db import models
 from django.contrib.gis.geos import Point
 
 import logging
+import threading
+from contextlib import contextmanager
 
 
 logger = logging.getLogger(__name__)
 
+_identity_map = threading.local()
+
+
+class LineUserManager(models.Manager):
+    @contextmanager
+    def identity_map(self, users=None):
+        """Share LineUser instances inside the block on the current thread.
+
+        Inside the block, ``get_cached`` fetches each user from database at
+        most once and always returns the same instance.
+
+        Args:
+            users (Dict[str, LineUser]): users that have already been fetched
+        """
+        previous_users = getattr(_identity_map, 'users', None)
+        _identity_map.users = dict(users or {})
+        try:
+            yield
+        finally:
+            _identity_map.users = previous_users
+
+    def get_cached(self, user_id):
+        users = getattr(_identity_map, 'users', None)
+        if users is None:
+            return self.get(user_id=user_id)
+
+        try:
+            return users[user_id]
+        except KeyError:
+            user = users[user_id] = self.get(user_id=user_id)
+            return user
+
+    def get_or_create_cached(self, user_id):
+        try:
+            return self.get_cached(user_id), False
+        except self.model.DoesNotExist:
+            user, created = self.get_or_create(user_id=user_id)
+            self.remember(user)
+            return user, created
+
+    @staticmethod
+    def remember(user):
+        users = getattr(_identity_map, 'users', None)
+        if users is not None:
+            users[user.user_id] = user
+
 
 class LineUser(models.Model):
     user_id = models.TextField(primary_key=True)
@@ -18,6 +66,8 @@ class LineUser(models.Model):
     location = models.ForeignKey('MinArea', null=True, on_delete=models.SET_NULL)
     zapper_id = models.TextField(null=True)
 
+    objects = LineUserManager()
+
     def save(self, *args, **kwargs):
         if self.lng and self.lat:
             try:
@@ -25,6 +75,7 @@ class LineUser(models.Model):
             except MinArea.DoesNotExist:
                 logger.error('The location of the user can not match any minarea')
         super(LineUser, self).save(*args, **kwargs)
+        LineUser.objects.remember(self)
 
     def __str__(self):
         return '{name} ({user_id})'.format(
@@ -131,3 +182,91 @@ class ReportZapperMsg(models.Model):
     reporter = models.ForeignKey(LineUser, related_name='report_zapper_msg', on_delete=models.CASCADE)
     report_time = models.DateTimeField()
     content = models.TextField()
+
+
+class WebhookEvent(models.Model):
+    user_id = models.TextField(db_index=True)
+    payload = models.TextField()
+    receive_time = models.DateTimeField(auto_now_add=True)
+    claim_time = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return '{receive_time} {user_id}'.format(
+            receive_time=self.receive_time,
+            user_id=self.user_id
+        )
+
+
+class PushCampaign(models.Model):
+    RUNNING = 'running'
+    DONE = 'done'
+
+    content = models.TextField(blank=True)
+    img = models.TextField(blank=True)
+    create_time = models.DateTimeField(auto_now_add=True)
+    status = models.TextField(default=RUNNING)
+    total_users = models.IntegerField(default=0)
+    sent_users = models.IntegerField(default=0)
+    failed_users = models.IntegerField(default=0)
+    heartbeat_time = models.DateTimeField(null=True)
+    # Changed whenever another runner claims the campaign, so that the former one stops
+    claim_token = models.TextField(null=True)
+    finish_time = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return '{create_time} {status} ({sent}/{total})'.format(
+            create_time=self.create_time,
+            status=self.status,
+            sent=self.sent_users,
+            total=self.total_users
+        )
+
+
+class PushBatch(models.Model):
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    campaign = models.ForeignKey(PushCampaign, related_name='batches', on_delete=models.CASCADE)
+    index = models.IntegerField()
+    # Snapshot of the recipients, one user id per line
+    user_ids = models.TextField()
+    status = models.TextField(default=PENDING)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+    send_time = models.DateTimeField(null=True)
+
+    class Meta:
+        unique_together = ('campaign', 'index')
+
+    def get_user_ids(self):
+        return self.user_ids.split('\n')
+
+    def __str__(self):
+        return '{campaign_id}#{index} {status}'.format(
+            campaign_id=self.campaign_id,
+            index=self.index,
+            status=self.status
+        )
+
+
+class GeocodeCache(models.Model):
+    # Normalized by geocoding.normalize_address
+    address = models.TextField(unique=True)
+    # Both are null if the address is not found
+    lng = models.FloatField(null=True)
+    lat = models.FloatField(null=True)
+    update_time = models.DateTimeField(auto_now=True)
+
+    def is_found(self):
+        return self.lng is not None and self.lat is not None
+
+    def get_location(self):
+        return (self.lng, self.lat) if self.is_found() else None
+
+    def __str__(self):
+        return '{address} ({lng}, {lat})'.format(
+            address=self.address,
+            lng=self.lng,
+            lat=self.lat
+        )
@@ -0,0 +1,377 @@
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+import logging
+import random
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from time import monotonic, sleep, time
+
+from requests import RequestException
+from linebot.exceptions import LineBotApiError
+from linebot.models import TextSendMessage, ImageSendMessage
+
+from .decorators import log_line_api_error
+from .models import LineUser, PushCampaign, PushBatch
+
+
+MULTICAST_LIMIT = 150
+BATCH_CREATE_SIZE = 500
+RATE_LIMIT_KEY = 'push_multicast_count'
+
+logger = logging.getLogger('django')
+
+
+class CampaignClaimed(Exception):
+    """The campaign is claimed by another runner, so this runner must stop sending it."""
+
+
+class TokenBucket:
+    """Token bucket that limits the rate of requests across threads.
+
+    Args:
+        rate (float): tokens added per second
+        capacity (int): max number of tokens, i.e., the burst size
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last_time = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, block until one is available."""
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_time) * self.rate)
+                self._last_time = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            sleep(wait)
+
+
+class SharedRateLimiter:
+    """Limit the rate of requests across every process that shares the cache.
+
+    Requests are counted in the cache per second of the wall clock, so all the
+    uWSGI workers and run_push_campaigns together send at most ``rate``
+    requests in a second. If the cache fails, the rate is only limited within
+    this process.
+
+    Args:
+        key (str): cache key prefix of the counters
+        rate (float): max requests per second
+    """
+
+    def __init__(self, key, rate):
+        self.key = key
+        self.rate = max(1, int(rate))
+        self._local_bucket = TokenBucket(rate, capacity=self.rate)
+
+    def acquire(self):
+        """Take a slot in the current second, block until one is available."""
+        while True:
+            now = time()
+            second = int(now)
+            key = '{}:{}'.format(self.key, second)
+            try:
+                cache.add(key, 0, timeout=10)
+                count = cache.incr(key)
+            except Exception as e:
+                logger.warning('Fail to count multicast requests in cache.\n %s', str(e))
+                self._local_bucket.acquire()
+                return
+            if count <= self.rate:
+                return
+            sleep(second + 1 - now)
+
+
+def chunk_user_ids(user_ids, size=MULTICAST_LIMIT):
+    """Split user ids into chunks of at most ``size`` users for multicast."""
+    chunk = list()
+    for user_id in user_ids:
+        chunk.append(user_id)
+        if len(chunk) == size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
+def is_retryable(error):
+    if isinstance(error, LineBotApiError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, RequestException)
+
+
+def area_audience(area_ids):
+    """Stream the ids of the users located in any of the areas with one query.
+
+    Args:
+        area_ids (List[str]): area_id of the MinArea
+
+    Returns:
+        Iterator[str]: distinct user ids
+    """
+    return (
+        LineUser.objects
+                .filter(location__area_id__in=area_ids)
+                .values_list('user_id', flat=True)
+                .distinct()
+                .iterator()
+    )
+
+
+def create_campaign(user_ids, content, img):
+    """Create a push campaign with a snapshot of its recipients.
+
+    The recipients are split into batches of MULTICAST_LIMIT users, so that the
+    progress of the campaign is tracked batch by batch. User ids are consumed
+    as a stream and written BATCH_CREATE_SIZE batches at a time.
+
+    Returns:
+        PushCampaign: the campaign, waiting to be run
+    """
+    with transaction.atomic():
+        campaign = PushCampaign.objects.create(content=content, img=img, heartbeat_time=timezone.now(),
+                                               claim_token=uuid.uuid4().hex)
+        batches = list()
+        for index, chunk in enumerate(chunk_user_ids(user_ids)):
+            batches.append(PushBatch(campaign=campaign, index=index, user_ids='\n'.join(chunk)))
+            campaign.total_users += len(chunk)
+            if len(batches) == BATCH_CREATE_SIZE:
+                PushBatch.objects.bulk_create(batches)
+                batches = list()
+        PushBatch.objects.bulk_create(batches)
+        campaign.save(update_fields=['total_users'])
+    return campaign
+
+
+def campaign_messages(campaign):
+    msgs = list()
+    if campaign.content:
+        msgs.append(TextSendMessage(text=campaign.content))
+    if campaign.img:
+        msgs.append(ImageSendMessage(original_content_url=campaign.img, preview_image_url=campaign.img))
+    return msgs
+
+
+def claim_stale_campaign(heartbeat_timeout):
+    """Claim an unfinished campaign whose runner has not reported for heartbeat_timeout seconds.
+
+    Returns:
+        PushCampaign: the claimed campaign, None if there is none
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        campaign = (
+            PushCampaign.objects
+                        .select_for_update(skip_locked=True)
+                        .filter(status=PushCampaign.RUNNING)
+                        .filter(Q(heartbeat_time__isnull=True) |
+                                Q(heartbeat_time__lt=now - timedelta(seconds=heartbeat_timeout)))
+                        .order_by('id')
+                        .first()
+        )
+        if campaign:
+            campaign.heartbeat_time = now
+            campaign.claim_token = uuid.uuid4().hex
+            campaign.save(update_fields=['heartbeat_time', 'claim_token'])
+    return campaign
+
+
+class PushEngine:
+    """Run push campaigns with concurrent multicast requests.
+
+    The pending batches of a campaign are sent by ``concurrency`` threads, all
+    through one SharedRateLimiter so that the workers together stay under the
+    multicast rate limit of LINE. A batch answered with 429 or 5xx (or failed by the
+    network) is retried with exponential backoff.
+
+    Results are committed to database every ``commit_size`` batches, together
+    with the counters of the campaign. The heartbeat of the campaign is
+    refreshed every ``heartbeat_interval`` seconds by a separate thread, so a
+    runner stuck in backoffs is still alive. A campaign whose runner died is
+    resumed from its pending batches by the run_push_campaigns command, so at
+    most the uncommitted batches are sent twice.
+
+    Each claim of a campaign changes its claim token. A runner whose token no
+    longer matches, found by its heartbeat or its commit, stops sending and
+    raises CampaignClaimed.
+
+    Args:
+        line_bot_api (linebot.LineBotApi): client to multicast with
+        concurrency (int): number of batches sent at the same time
+        rate (float): max multicast requests per second of all the processes
+        max_retries (int): max retries of a batch
+        backoff (float): seconds to wait before the first retry, doubled on each retry
+        commit_size (int): number of finished batches committed at once
+        heartbeat_interval (float): seconds between two heartbeats of a running campaign
+
+    Examples:
+        >>> campaign = create_campaign(user_ids, content='Hi', img='')
+        >>> push_engine.start(campaign)
+    """
+
+    def __init__(self, line_bot_api, concurrency, rate, max_retries, backoff, commit_size, heartbeat_interval):
+        self.line_bot_api = line_bot_api
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.commit_size = commit_size
+        self.heartbeat_interval = heartbeat_interval
+        self.rate_limiter = SharedRateLimiter(RATE_LIMIT_KEY, rate)
+
+    def start(self, campaign):
+        """Run a campaign in background."""
+        threading.Thread(target=self._run_in_background, args=(campaign,),
+                         name='push-campaign-{}'.format(campaign.id), daemon=True).start()
+
+    def run(self, campaign):
+        """Send the pending batches of a campaign and block until they are done.
+
+        Raises:
+            CampaignClaimed: if another runner claims the campaign meanwhile
+        """
+        token = campaign.claim_token
+        finished = threading.Event()
+        stop_sending = threading.Event()
+        heartbeat = threading.Thread(target=self._beat, args=(campaign, token, finished, stop_sending),
+                                     name='push-heartbeat-{}'.format(campaign.id), daemon=True)
+        heartbeat.start()
+        try:
+            self._send_batches(campaign, token, stop_sending)
+        finally:
+            finished.set()
+            heartbeat.join()
+
+        PushCampaign.objects.filter(id=campaign.id, claim_token=token).update(
+            status=PushCampaign.DONE, finish_time=timezone.now()
+        )
+        campaign.refresh_from_db()
+        logger.info('Push campaign %s is done. %s users sent, %s users failed',
+                    campaign.id, campaign.sent_users, campaign.failed_users)
+
+    def _send_batches(self, campaign, token, stop_sending):
+        batches = list(campaign.batches.filter(status=PushBatch.PENDING).order_by('index'))
+        messages = campaign_messages(campaign)
+
+        finished_batches = list()
+        # Only this thread and the heartbeat touch database, the sending threads just multicast
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {
+                executor.submit(self.send_chunk, batch.get_user_ids(), messages, stop_sending): batch
+                for batch in batches
+            }
+            try:
+                for future in as_completed(futures):
+                    if stop_sending.is_set():
+                        raise CampaignClaimed(campaign.id)
+
+                    batch = futures[future]
+                    try:
+                        result = future.result()
+                    except CampaignClaimed:
+                        raise
+                    except Exception as e:
+                        logger.exception('Fail to send batch %s.\n %s', batch, str(e))
+                        result = {'status': PushBatch.FAILED, 'attempts': 1, 'error': str(e)}
+                    batch.status = result['status']
+                    batch.attempts += result['attempts']
+                    batch.error = result['error']
+                    batch.send_time = timezone.now()
+
+                    finished_batches.append(batch)
+                    if len(finished_batches) >= self.commit_size:
+                        self._commit(campaign, token, finished_batches)
+                        finished_batches = list()
+            except Exception:
+                # Batches that are not sent yet are left pending for the resume
+                stop_sending.set()
+                for future in futures:
+                    future.cancel()
+                raise
+        self._commit(campaign, token, finished_batches)
+
+    def send_chunk(self, user_ids, messages, stop_sending=None):
+        """Multicast messages to a chunk of users with retries.
+
+        Args:
+            stop_sending (threading.Event): stop before the next attempt once it is set
+
+        Returns:
+            dict: status (sent or failed), attempts and error of the chunk
+        """
+        attempts = 0
+        while True:
+            attempts += 1
+            self.rate_limiter.acquire()
+            if stop_sending is not None and stop_sending.is_set():
+                raise CampaignClaimed()
+            try:
+                self.line_bot_api.multicast(user_ids, messages)
+                return {'status': PushBatch.SENT, 'attempts': attempts, 'error': None}
+            except (LineBotApiError, RequestException) as error:
+                if not is_retryable(error) or attempts > self.max_retries:
+                    if isinstance(error, LineBotApiError):
+                        log_line_api_error(error)
+                        message = error.error.message
+                    else:
+                        logger.warning('Fail to multicast.\n %s', str(error))
+                        message = str(error)
+                    return {'status': PushBatch.FAILED, 'attempts': attempts, 'error': message}
+                # Jitter keeps the retries of concurrent chunks apart
+                sleep(self.backoff * 2 ** (attempts - 1) * random.uniform(0.5, 1.5))
+
+    def _run_in_background(self, campaign):
+        try:
+            self.run(campaign)
+        except CampaignClaimed:
+            logger.warning('Push campaign %s is claimed by another runner. Stop sending it.', campaign.id)
+        except Exception as e:
+            logger.exception('Push campaign %s stops. It will be resumed by run_push_campaigns.\n %s',
+                             campaign.id, str(e))
+        finally:
+            connection.close()
+
+    def _beat(self, campaign, token, finished, stop_sending):
+        try:
+            while not finished.wait(self.heartbeat_interval):
+                try:
+                    beaten = PushCampaign.objects.filter(id=campaign.id, claim_token=token).update(
+                        heartbeat_time=timezone.now()
+                    )
+                except Exception as e:
+                    logger.exception('Fail to beat push campaign %s.\n %s', campaign.id, str(e))
+                    continue
+                if not beaten:
+                    stop_sending.set()
+                    return
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _commit(campaign, token, batches):
+        if not batches:
+            return
+        sent_users = sum(len(batch.get_user_ids()) for batch in batches if batch.status == PushBatch.SENT)
+        failed_users = sum(len(batch.get_user_ids()) for batch in batches if batch.status == PushBatch.FAILED)
+        with transaction.atomic():
+            # Locks the campaign, so that it can not be claimed before the batches are saved
+            committed = PushCampaign.objects.filter(id=campaign.id, claim_token=token).update(
+                sent_users=F('sent_users') + sent_users,
+                failed_users=F('failed_users') + failed_users,
+                heartbeat_time=timezone.now()
+            )
+            if not committed:
+                raise CampaignClaimed(campaign.id)
+            PushBatch.objects.bulk_update(batches, ['status', 'attempts', 'error', 'send_time'])
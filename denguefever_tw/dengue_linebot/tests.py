@@ -1,3 +1,209 @@
-from django.test import TestCase
+from django.conf import settings
+from django.test import SimpleTestCase
 
-# Create your tests here.
+import json
+import os
+import random
+import unittest
+from itertools import product
+from types import SimpleNamespace
+from unittest import mock
+
+import requests
+from linebot import LineBotApi
+from linebot.models import TextSendMessage
+
+from .denguebot_fsm.condition_matcher import ConditionMatcher, KeywordAutomaton
+from .push_engine import PushEngine
+from .models import PushBatch
+from .transport import TransportHttpClient, transport
+
+try:
+    from condconf import CondMeta, cond_func_generator
+except ImportError:
+    CondMeta = cond_func_generator = None
+
+
+COND_CONFIG_PATH = os.path.join(settings.STATIC_ROOT, 'dengue_linebot/config/zh_tw/cond_config.json')
+TEXT_PREPROCESS_CODE = ['msg = event.message.text']
+
+
+def naive_evaluate(condition, msg):
+    """The semantics of a condition in cond_config.json, one check at a time."""
+    cond_type, content = condition['type'], condition['content']
+    if cond_type == 'any':
+        return any(keyword in msg for keyword in content)
+    elif cond_type == 'all':
+        return all(keyword in msg for keyword in content)
+    elif cond_type == 'match':
+        return msg in content
+    elif cond_type == 'complex-any':
+        return any(naive_evaluate(sub_condition, msg) for sub_condition in content)
+    elif cond_type == 'complex-all':
+        return all(naive_evaluate(sub_condition, msg) for sub_condition in content)
+    raise ValueError('Unknown condition type {}'.format(cond_type))
+
+
+def collect_keywords(condition):
+    if condition['type'].startswith('complex'):
+        return [keyword for sub_condition in condition['content'] for keyword in collect_keywords(sub_condition)]
+    return list(condition['content'])
+
+
+def sample_messages(condition_config, count, seed=0):
+    """Messages made of the keywords of the config, alone, joined and padded."""
+    keywords = sorted({keyword for condition in condition_config
+                       for keyword in collect_keywords(condition['condition'])})
+    fillers = ['', '請問', '的', '?', ' ', '嗎', '是']
+    messages = ['', '你好嗎', '今天天氣很好'] + keywords
+    messages.extend(keyword + filler for keyword, filler in product(keywords, fillers))
+
+    rand = random.Random(seed)
+    for _ in range(count):
+        parts = rand.sample(keywords, rand.randint(1, 4))
+        messages.append(rand.choice(fillers).join(parts))
+        # Cut a keyword so that partial keywords are scanned as well
+        keyword = rand.choice(keywords)
+        messages.append(keyword[:rand.randint(0, len(keyword))] + rand.choice(keywords))
+    return messages
+
+
+def text_event(text):
+    return SimpleNamespace(type='message', message=SimpleNamespace(type='text', text=text))
+
+
+class FakeMachine:
+    def __init__(self):
+        self._condition_bits = dict()
+
+    @staticmethod
+    def is_postback_event(event):
+        return event.type == 'postback'
+
+    @staticmethod
+    def is_text_message(event):
+        return event.type == 'message' and event.message.type == 'text'
+
+
+def http_response(status_code, body, reason=''):
+    response = requests.models.Response()
+    response.status_code = status_code
+    response.reason = reason
+    response._content = body.encode('utf-8')
+    return response
+
+
+class KeywordAutomatonTest(SimpleTestCase):
+    def test_scan_overlapping_keywords(self):
+        automaton = KeywordAutomaton(['he', 'she', 'his', 'hers'])
+        self.assertEqual(automaton.scan('ushers'), 0b1011)
+        self.assertEqual(automaton.scan('hishe'), 0b0111)
+
+    def test_scan_keyword_that_is_suffix_of_another_path(self):
+        # 'bc' ends inside 'abcd', so it is only found through the output of a fail link
+        automaton = KeywordAutomaton(['abcd', 'bc', 'c'])
+        self.assertEqual(automaton.scan('abcx'), 0b110)
+        self.assertEqual(automaton.scan('abcd'), 0b111)
+
+    def test_scan_without_keywords(self):
+        automaton = KeywordAutomaton(['登革熱', '症狀'])
+        self.assertEqual(automaton.scan(''), 0)
+        self.assertEqual(automaton.scan('登革'), 0)
+        self.assertEqual(KeywordAutomaton([]).scan('登革熱'), 0)
+
+    def test_scan_same_as_substring_checks(self):
+        rand = random.Random(0)
+        for _ in range(200):
+            keywords = list({''.join(rand.choices('abc', k=rand.randint(1, 4))) for _ in range(6)})
+            automaton = KeywordAutomaton(keywords)
+            for _ in range(20):
+                text = ''.join(rand.choices('abcd', k=rand.randint(0, 12)))
+                expected = sum(1 << index for index, keyword in enumerate(keywords) if keyword in text)
+                self.assertEqual(automaton.scan(text), expected, (keywords, text))
+
+
+class ConditionMatcherTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with open(COND_CONFIG_PATH) as cond_file:
+            cls.condition_config = json.load(cond_file)
+        cls.matcher = ConditionMatcher(cls.condition_config, preprocess_code=TEXT_PREPROCESS_CODE)
+        cls.messages = sample_messages(cls.condition_config, count=2000)
+
+    def test_evaluate_same_as_naive_evaluation(self):
+        for msg in self.messages:
+            satisfied = self.matcher.evaluate(msg)
+            for index, condition in enumerate(self.condition_config):
+                self.assertEqual(bool(satisfied >> index & 1), naive_evaluate(condition['condition'], msg),
+                                 (condition['name'], msg))
+
+    def test_match_is_exact(self):
+        index = self.matcher.condition_names.index('is_selecting_zapper_cond')
+        self.assertTrue(self.matcher.evaluate('我的捕蚊燈狀況') >> index & 1)
+        self.assertFalse(self.matcher.evaluate('我的捕蚊燈狀況?') >> index & 1)
+
+    def test_condition_method_uses_preprocess_code_of_condition(self):
+        is_greeting = self.matcher.condition_method('is_greeting')
+        self.assertTrue(is_greeting(FakeMachine(), text_event('  HELLO ')))
+
+        is_asking_self_prevention = self.matcher.condition_method('is_asking_self_prevention')
+        postback = SimpleNamespace(type='postback', postback=SimpleNamespace(data='自身'))
+        self.assertTrue(is_asking_self_prevention(FakeMachine(), postback))
+
+    def test_rebuild_with_automaton_of_other_config(self):
+        other = ConditionMatcher([{'name': 'is_other', 'condition': {'type': 'any', 'content': ['其他']}}])
+        matcher = ConditionMatcher(self.condition_config, automaton=other.automaton)
+        self.assertIsNot(matcher.automaton, other.automaton)
+        self.assertEqual(matcher.evaluate('登革熱'), self.matcher.evaluate('登革熱'))
+
+    @unittest.skipIf(cond_func_generator is None, 'condconf is not installed')
+    def test_condition_methods_same_as_condconf(self):
+        cond_funcs = cond_func_generator(
+            self.condition_config,
+            template_args={
+                'decorators': ['keep'],
+                'func_args': ['self', 'event'],
+                'preprocess_code': TEXT_PREPROCESS_CODE
+            },
+            cond_var_name='msg'
+        )
+        condconf_cls = CondMeta('CondconfMachine', (FakeMachine,), dict(),
+                                cond_funcs=cond_funcs, external_globals={'keep': lambda func: func})
+        condconf_machine, machine = condconf_cls(), FakeMachine()
+
+        for msg in self.messages:
+            event = text_event(msg)
+            for name in self.matcher.condition_names:
+                self.assertEqual(bool(getattr(condconf_machine, name)(event)),
+                                 self.matcher.condition_method(name)(machine, event),
+                                 (name, msg))
+
+
+class PushEngineTest(SimpleTestCase):
+    def setUp(self):
+        line_bot_api = LineBotApi('token', http_client=TransportHttpClient)
+        self.push_engine = PushEngine(line_bot_api, concurrency=1, rate=1000, max_retries=2, backoff=0,
+                                      commit_size=1, heartbeat_interval=1)
+        self.messages = [TextSendMessage(text='Hi')]
+
+    def send_chunk(self, *responses):
+        with mock.patch.object(transport, 'post', side_effect=responses):
+            return self.push_engine.send_chunk(['user'], self.messages)
+
+    def test_retry_bad_gateway_with_html_body(self):
+        result = self.send_chunk(http_response(502, '<html>Bad Gateway</html>', 'Bad Gateway'),
+                                 http_response(200, '{}'))
+        self.assertEqual(result['status'], PushBatch.SENT)
+        self.assertEqual(result['attempts'], 2)
+
+    def test_fail_after_max_retries(self):
+        result = self.send_chunk(*[http_response(503, '<html>Service Unavailable</html>', 'Service Unavailable')] * 3)
+        self.assertEqual(result['status'], PushBatch.FAILED)
+        self.assertEqual(result['attempts'], 3)
+        self.assertEqual(result['error'], '503 Service Unavailable')
+
+    def test_not_retry_client_error(self):
+        result = self.send_chunk(http_response(400, '{"message": "The request body has 1 error(s)"}'))
+        self.assertEqual(result['status'], PushBatch.FAILED)
+        self.assertEqual(result['attempts'], 1)
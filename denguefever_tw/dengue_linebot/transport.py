@@ -0,0 +1,157 @@
+from django.conf import settings
+
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+
+
+class HostPool:
+    """Keep-alive connections and concurrency limit of one host.
+
+    Args:
+        max_connections (int): max number of concurrent requests and kept-alive connections
+    """
+
+    def __init__(self, max_connections):
+        self.max_connections = max_connections
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.waiting = 0
+        self.total_time = 0.0
+        self._semaphore = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self):
+        with self._lock:
+            self.waiting += 1
+        self._semaphore.acquire()
+        with self._lock:
+            self.waiting -= 1
+            self.in_flight += 1
+
+        start = perf_counter()
+        try:
+            yield
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.requests += 1
+                self.total_time += perf_counter() - start
+            self._semaphore.release()
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'avg_ms': round(self.total_time / self.requests * 1000, 3) if self.requests else None,
+        }
+
+
+class Transport:
+    """Shared HTTP transport of all the outbound calls.
+
+    Requests to a host reuse the kept-alive connections of its pool, run at most
+    ``max_connections`` at a time and default to explicit connect and read
+    timeouts.
+
+    Args:
+        max_connections (int): max number of concurrent requests to a host
+        connect_timeout (float): seconds to wait for a connection
+        read_timeout (float): seconds to wait between two bytes of a response
+
+    Examples:
+        >>> response = transport.get('https://mosquitokiller.csie.ncku.edu.tw/apis/lamps/1')
+        >>> transport.stats()
+        {'mosquitokiller.csie.ncku.edu.tw': {'requests': 1, ...}}
+    """
+
+    def __init__(self, max_connections, connect_timeout, read_timeout):
+        self.max_connections = max_connections
+        self.timeout = (connect_timeout, read_timeout)
+        self._pools = dict()
+        self._lock = threading.Lock()
+
+    def pool_of(self, url):
+        host = urlsplit(url).netloc
+        pool = self._pools.get(host)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.setdefault(host, HostPool(self.max_connections))
+        return pool
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        pool = self.pool_of(url)
+        with pool.slot():
+            return pool.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """Request counts, in-flight and waiting requests and average latency of each host."""
+        return {host: pool.stats() for host, pool in list(self._pools.items())}
+
+
+transport = Transport(
+    max_connections=settings.DENGUE_BOT_HTTP_MAX_CONNECTIONS,
+    connect_timeout=settings.DENGUE_BOT_HTTP_CONNECT_TIMEOUT,
+    read_timeout=settings.DENGUE_BOT_HTTP_READ_TIMEOUT,
+)
+
+
+class TransportHttpResponse(RequestsHttpResponse):
+    """Response of LineBotApi whose error body may not be JSON.
+
+    line-bot-sdk decodes the body of every error response as JSON, so an HTML
+    page of a proxy, e.g., 502 Bad Gateway, raises ValueError instead of
+    LineBotApiError and loses the status code. Such a body is replaced by an
+    error message, so the status code decides whether to retry.
+    """
+
+    @property
+    def json(self):
+        try:
+            return self.response.json()
+        except ValueError:
+            if 200 <= self.status_code < 300:
+                raise
+            return {'message': '{} {}'.format(self.status_code, self.response.reason)}
+
+
+class TransportHttpClient(RequestsHttpClient):
+    """HTTP client of LineBotApi that sends requests through the shared transport.
+
+    Examples:
+        >>> line_bot_api = LineBotApi(token, http_client=TransportHttpClient)
+    """
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = transport.get(url, headers=headers, params=params, stream=stream, timeout=timeout)
+        return TransportHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = transport.post(url, headers=headers, data=data, timeout=timeout)
+        return TransportHttpResponse(response)
@@ -8,6 +8,7 @@ urlpatterns = [
     url(r'^$', index),
     url(r'^show_fsm/$', show_fsm, name='Show FSM'),
     url(r'^reload_fsm/$', reload_fsm, name='Reload FSM'),
+    url(r'^fsm_traces/$', fsm_traces, name='FSM Traces'),
     url(r'^user_list/$', user_list, name='User List'),
     url(r'^(?P<uid>\S+)/user_detail/$', user_detail, name='User Detail'),
     url(r'^msg_log_list/$', msg_log_list, name='Msg Log List'),
@@ -22,6 +23,8 @@ urlpatterns = [
     url(r'^export_msg_log/$', export_msg_log, name='Export Msg Log'),
     url(r'^push_msg/$', push_msg_form, name='Push Message'),
     url(r'^push_msg_result/$', push_msg_result, name='push_msg_result'),
+    url(r'^(?P<campaign_id>\d+)/push_campaign_detail/$', push_campaign_detail,
+        name='Push Campaign Detail'),
     url(r'^area_list/$', area_list, name='Area List'),
     url(r'^(?P<area_id>\S+)/area_detail/$', area_detail, name='Area Detail')
 ]
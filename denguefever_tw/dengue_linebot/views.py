@@ -1,29 +1,42 @@
 from django.contrib import auth, messages
 from django.conf import settings
-from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseRedirect
+from django.http import (
+    FileResponse, HttpResponse, HttpResponseBadRequest, HttpResponseRedirect, JsonResponse
+)
 from django.core.cache import cache
-from django.shortcuts import render
+from django.shortcuts import get_object_or_404, render
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import condition, require_POST
 from django.contrib.auth.decorators import login_required
 
 import csv
+import gc
+import hashlib
 import os
 import logging
+import tempfile
+import threading
+from concurrent.futures import wait
 from itertools import chain
 from pprint import pformat
+from time import monotonic
 
-import ujson
-from jsmin import jsmin
-from linebot import LineBotApi, WebhookParser
+from linebot import WebhookParser
 from linebot.exceptions import InvalidSignatureError, LineBotApiError
 
 from .decorators import log_line_api_error, log_received_event
-from .utils import push_msg
+from .dispatcher import EventDispatcher
+from .log_writer import log_writer
+from .push_engine import PushEngine, area_audience, create_campaign
+from .transport import TransportHttpClient
 from .denguebot_fsm import generate_fsm_cls
+from .denguebot_fsm.config_cache import load_fsm_config
+from .denguebot_fsm.static_reply import StaticReplyLineBotApi
+from .denguebot_fsm.tracing import fsm_tracer
 from .models import (
     MessageLog, LineUser, Suggestion, GovReport,
-    BotReplyLog, UnrecognizedMsg, ResponseToUnrecogMsg, MinArea
+    BotReplyLog, UnrecognizedMsg, ResponseToUnrecogMsg, MinArea, WebhookEvent,
+    PushCampaign, PushBatch
 )
 
 
@@ -33,34 +46,54 @@ BOT_TEMPLATE_PATH = os.path.join(
     'dengue_linebot/templates/dengue_linebot/bot_templates'
 )
 DEFAULT_LANGUAGE = 'zh_tw'
+FSM_VERSION_KEY = 'dengue_bot_fsm_version'
+FSM_GRAPH_FORMATS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
 
 
 logger = logging.getLogger('django')
 
-line_bot_api = LineBotApi(settings.LINE_CHANNEL_ACCESS_TOKEN)
+line_bot_api = StaticReplyLineBotApi(settings.LINE_CHANNEL_ACCESS_TOKEN, http_client=TransportHttpClient)
 line_parser = WebhookParser(settings.LINE_CHANNEL_SECRET)
+push_engine = PushEngine(
+    line_bot_api,
+    concurrency=settings.DENGUE_BOT_PUSH_CONCURRENCY,
+    rate=settings.DENGUE_BOT_PUSH_RATE,
+    max_retries=settings.DENGUE_BOT_PUSH_MAX_RETRIES,
+    backoff=settings.DENGUE_BOT_PUSH_BACKOFF,
+    commit_size=settings.DENGUE_BOT_PUSH_COMMIT_BATCHES,
+    heartbeat_interval=settings.DENGUE_BOT_PUSH_HEARTBEAT_INTERVAL,
+)
 
 dengue_bot_fsms = dict()
+unsupported_languages = set()
+
+fsm_version = None
+seen_fsm_version = None
+fsm_version_checked_time = 0
+fsm_rebuild_thread = None
+fsm_rebuild_lock = threading.Lock()
+
+event_dispatcher = None
+event_dispatcher_lock = threading.Lock()
+
+fsm_graph_lock = threading.Lock()
 
 
 def _generate_fsm(language):
     cond_path = os.path.join(CONFIG_PATH, language)
     cond_path = os.path.join(cond_path, 'cond_config.json')
-    with open(cond_path) as cond_file:
-        cond_config = ujson.load(cond_file)
+    fsm_config_path = os.path.join(CONFIG_PATH, 'FSM.json')
+    config = load_fsm_config(fsm_config_path, cond_path, settings.DENGUE_BOT_FSM_CACHE_DIR)
 
     cls_name = language + '_FSM'
-    fsm_cls = generate_fsm_cls(cls_name, cond_config)
-
-    fsm_config_path = os.path.join(CONFIG_PATH, 'FSM.json')
-    with open(fsm_config_path, 'r') as fsm_config_file:
-        data = ujson.loads(jsmin(fsm_config_file.read()))
-        states = data['states']
-        transitions = data['transitions']
+    fsm_cls = generate_fsm_cls(cls_name, config['condition_config'], automaton=config['automaton'])
 
     return fsm_cls(
-        states=states,
-        transitions=transitions,
+        states=config['states'],
+        transitions=config['transitions'],
         bot_client=line_bot_api,
         template_path=os.path.join(BOT_TEMPLATE_PATH, language),
     )
@@ -70,17 +103,234 @@ def _get_fsm(language):
     machine = dengue_bot_fsms.get(language)
     if machine:
         return machine
+    elif language in unsupported_languages:
+        return _get_fsm(DEFAULT_LANGUAGE)
     else:
         try:
             dengue_bot_fsms[language] = _generate_fsm(language)
         except FileNotFoundError:
+            if language == DEFAULT_LANGUAGE:
+                raise
             logger.info('%s FSM is not supported', language)
-            return dengue_bot_fsms['zh_tw']
+            unsupported_languages.add(language)
+            return _get_fsm(DEFAULT_LANGUAGE)
         else:
             logger.info('%s FSM is generated', language)
             return dengue_bot_fsms[language]
 
 
+def _list_languages():
+    return sorted(
+        language for language in os.listdir(CONFIG_PATH)
+        if os.path.isfile(os.path.join(CONFIG_PATH, language, 'cond_config.json'))
+    )
+
+
+def fsm_config_version():
+    """Content hash of FSM.json, cond_config.json of all the languages and the bot templates.
+
+    Files are named relative to their root, so the version does not depend on
+    where the project is deployed.
+    """
+    paths = [('config', 'FSM.json')]
+    paths.extend(('config', os.path.join(language, 'cond_config.json'))
+                 for language in _list_languages())
+    for root, _, file_names in os.walk(BOT_TEMPLATE_PATH):
+        paths.extend(('templates', os.path.relpath(os.path.join(root, file_name), BOT_TEMPLATE_PATH))
+                     for file_name in file_names)
+
+    roots = {'config': CONFIG_PATH, 'templates': BOT_TEMPLATE_PATH}
+    digest = hashlib.sha1()
+    for root, path in sorted(paths):
+        digest.update('{}/{}'.format(root, path.replace(os.sep, '/')).encode('utf-8'))
+        with open(os.path.join(roots[root], path), 'rb') as config_file:
+            digest.update(config_file.read())
+    return digest.hexdigest()
+
+
+def _build_fsms():
+    version = fsm_config_version()
+    machines = {language: _generate_fsm(language) for language in _list_languages()}
+    return version, machines
+
+
+def prebuild_fsms():
+    """Build the FSMs of all the languages under CONFIG_PATH.
+
+    This should run before uWSGI forks the workers. The built machines are
+    then moved out of the garbage collector's sight (Python 3.7+), so the
+    workers share them through copy-on-write instead of each building and
+    touching its own copy.
+
+    A failure is logged, and the machines are then built lazily by _get_fsm.
+    """
+    global dengue_bot_fsms, fsm_version
+    try:
+        fsm_version, dengue_bot_fsms = _build_fsms()
+    except Exception as e:
+        logger.exception('Fail to prebuild FSMs, they will be built on demand.\n %s', str(e))
+        return
+    logger.info('FSMs of %s (version %s) are generated', ', '.join(dengue_bot_fsms), fsm_version)
+
+    if hasattr(gc, 'freeze'):
+        gc.collect()
+        gc.freeze()
+
+
+def _check_fsm_version(force=False):
+    """Rebuild the FSMs in background if a new version is broadcast through the cache.
+
+    The broadcast version is read at most once per
+    DENGUE_BOT_FSM_VERSION_CHECK_INTERVAL seconds.
+    """
+    global seen_fsm_version, fsm_version_checked_time, fsm_rebuild_thread
+    now = monotonic()
+    if not force and now - fsm_version_checked_time < settings.DENGUE_BOT_FSM_VERSION_CHECK_INTERVAL:
+        return
+    fsm_version_checked_time = now
+
+    broadcast_version = cache.get(FSM_VERSION_KEY)
+    if not force and broadcast_version in (None, fsm_version, seen_fsm_version):
+        return
+
+    with fsm_rebuild_lock:
+        if fsm_rebuild_thread and fsm_rebuild_thread.is_alive():
+            return
+        seen_fsm_version = broadcast_version
+        fsm_rebuild_thread = threading.Thread(target=_rebuild_fsms, name='fsm-rebuild', daemon=True)
+        fsm_rebuild_thread.start()
+
+
+def _rebuild_fsms():
+    global dengue_bot_fsms, fsm_version
+    try:
+        version, machines = _build_fsms()
+    except Exception as e:
+        logger.exception('Fail to rebuild FSMs.\n %s', str(e))
+        return
+
+    # Events in flight keep the machines they have got
+    dengue_bot_fsms, fsm_version = machines, version
+    unsupported_languages.clear()
+    logger.info('FSMs of version %s are swapped in', version)
+
+
+def _get_event_dispatcher():
+    # Threads must be started after uWSGI forks the workers
+    global event_dispatcher
+    with event_dispatcher_lock:
+        if event_dispatcher is None:
+            event_dispatcher = EventDispatcher(settings.DENGUE_BOT_EVENT_SHARDS)
+    return event_dispatcher
+
+
+def handle_events(events, dispatcher=None):
+    """Advance the FSMs of the users who sent the events.
+
+    Users and their states are fetched for all the events at once, and the new
+    states are written back at once, so the round-trips to database and cache
+    do not grow with the number of events.
+
+    Args:
+        events (List[linebot.models.Event]): events in the order Line sent them
+        dispatcher (EventDispatcher): handle events of different users in parallel if given
+    """
+    _check_fsm_version()
+
+    user_ids = list({event.source.user_id for event in events})
+    line_users = LineUser.objects.in_bulk(user_ids)
+    states = cache.get_many(user_ids)
+    new_states = dict()
+
+    def handle(event):
+        # Events of the same user are handled in order, so the state is up-to-date
+        user_id = event.source.user_id
+        state = new_states.get(user_id) or states.get(user_id) or 'user'
+        try:
+            new_state = handle_event(event, line_users.get(user_id), state)
+        except Exception as e:
+            logger.exception('Exception occurs when handle event of %s.\n %s', user_id, str(e))
+            return
+        if new_state:
+            new_states[user_id] = new_state
+
+    try:
+        if dispatcher and len(events) > 1:
+            wait(dispatcher.dispatch(events, handler=handle))
+        else:
+            for event in events:
+                handle(event)
+    finally:
+        # The states of the other users are kept even if one event fails
+        if new_states:
+            cache.set_many(new_states)
+
+
+def handle_event(event, line_user=None, state='user'):
+    """Advance the FSM of the user who sent the event.
+
+    Args:
+        event (linebot.models.Event): the event
+        line_user (LineUser): the user who sent the event, fetched if not given
+        state (str): the state of the user before the event
+
+    Returns:
+        str: the state of the user after the event, None if the event failed
+    """
+    prefetched_users = {line_user.user_id: line_user} if line_user else None
+    # All the lookups of the user while handling this event share one instance
+    with LineUser.objects.identity_map(prefetched_users):
+        return _handle_event(event, state)
+
+
+def _handle_event(event, state):
+    user_id = event.source.user_id
+
+    try:
+        line_user = _get_or_join_user(event)
+    except LineBotApiError as error:
+        log_line_api_error(error)
+        return None
+    except Exception as e:
+        logger.exception('Exception occurs when fetch user %s.\n %s', user_id, str(e))
+        return None
+
+    language = line_user.language
+
+    log_received_event(event, state)
+
+    machine = _get_fsm(language).spawn(state)
+
+    try:
+        with fsm_tracer.trace(machine, event):
+            advance_status = machine.advance(event)
+
+        logger.info(
+            ('After Advance\n'
+             'Advance Status: %s\n'
+             'User ID: %s\n'
+             'Macinhe State: %s\n'),
+            advance_status, user_id, machine.state
+        )
+        return machine.state
+    except LineBotApiError as error:
+        log_line_api_error(error)
+        machine.reset_state()
+    except Exception as e:
+        logger.exception('Exception occurs when recevie event.\n %s', str(e))
+        machine.reset_state()
+
+
+def _get_or_join_user(event):
+    user_id = event.source.user_id
+    try:
+        return LineUser.objects.get_cached(user_id)
+    except LineUser.DoesNotExist:
+        machine = _get_fsm(DEFAULT_LANGUAGE).spawn()
+        machine.on_enter_user_join(event)
+        return LineUser.objects.get_cached(user_id)
+
+
 @csrf_exempt
 def login(request):
     if request.user.is_authenticated():
@@ -120,66 +370,78 @@ def reply(request):
         log_line_api_error(error)
         return HttpResponseBadRequest()
 
-    for event in events:
-        user_id = event.source.user_id
+    if settings.DENGUE_BOT_ASYNC_WEBHOOK:
+        # Leave the FSM to `manage.py run_bot_workers` and answer Line at once
+        WebhookEvent.objects.bulk_create([
+            WebhookEvent(user_id=event.source.user_id, payload=event.as_json_string())
+            for event in events
+        ])
+        return HttpResponse()
 
-        try:
-            line_user = LineUser.objects.get(user_id=user_id)
-        except LineUser.DoesNotExist:
-            machine = _get_fsm(DEFAULT_LANGUAGE)
-            machine.on_enter_user_join(event)
+    if settings.DENGUE_BOT_EVENT_SHARDS > 1:
+        handle_events(events, dispatcher=_get_event_dispatcher())
+    else:
+        handle_events(events)
+    log_writer.flush_request()
+    return HttpResponse()
 
-            line_user = LineUser.objects.get(user_id=user_id)
 
-        state = cache.get(user_id) or 'user'
-        language = line_user.language
+@login_required
+def index(request):
+    return render(request, 'dengue_linebot/index.html')
 
-        log_received_event(event, state)
 
-        machine = _get_fsm(language)
-        machine.set_state(state)
+def _fsm_graph_format(request):
+    return request.GET.get('format', 'png')
 
-        try:
-            advance_status = machine.advance(event)
-            cache.set(user_id, machine.state)
-
-            logger.info(
-                ('After Advance\n'
-                 'Advance Status: %s\n'
-                 'User ID: %s\n'
-                 'Macinhe State: %s\n'
-                 'User State: %s\n'),
-                advance_status, user_id, machine.state, cache.get(user_id)
-            )
-        except LineBotApiError as error:
-            log_line_api_error(error)
-            machine.reset_state()
-        except Exception as e:
-            logger.exception('Exception occurs when recevie event.\n %s', str(e))
-            machine.reset_state()
-    return HttpResponse()
 
+def _fsm_graph_etag(request):
+    return '{}-{}'.format(fsm_version or fsm_config_version(), _fsm_graph_format(request))
 
-@login_required
-def index(request):
-    return render(request, 'dengue_linebot/index.html')
+
+def _render_fsm_graph(version, graph_format):
+    """Render the graph of the default FSM once per config version and return its path."""
+    graph_dir = settings.DENGUE_BOT_FSM_CACHE_DIR or tempfile.gettempdir()
+    graph_path = os.path.join(graph_dir, 'fsm-graph-{}.{}'.format(version, graph_format))
+    with fsm_graph_lock:
+        if not os.path.exists(graph_path):
+            os.makedirs(graph_dir, exist_ok=True)
+            # pygraphviz decides the format by the extension of the path
+            fd, temp_path = tempfile.mkstemp(dir=graph_dir, suffix='.' + graph_format)
+            os.close(fd)
+            _get_fsm(DEFAULT_LANGUAGE).draw_graph(temp_path, prog='dot')
+            os.replace(temp_path, graph_path)
+            logger.info('FSM graph %s is rendered', graph_path)
+    return graph_path
 
 
 @login_required
+@condition(etag_func=_fsm_graph_etag)
 def show_fsm(request):
-    machine = _get_fsm(DEFAULT_LANGUAGE)
-    resp = HttpResponse(content_type="image/png")
-    resp.name = 'state.png'
-    machine = _get_fsm(DEFAULT_LANGUAGE)
-    machine.draw_graph(resp, prog='dot')
-    return resp
+    graph_format = _fsm_graph_format(request)
+    if graph_format not in FSM_GRAPH_FORMATS:
+        return HttpResponseBadRequest()
+
+    graph_path = _render_fsm_graph(fsm_version or fsm_config_version(), graph_format)
+    return FileResponse(open(graph_path, 'rb'), content_type=FSM_GRAPH_FORMATS[graph_format])
+
+
+@login_required
+def fsm_traces(request):
+    try:
+        limit = int(request.GET.get('limit', 0))
+    except ValueError:
+        return HttpResponseBadRequest()
+    return JsonResponse(fsm_tracer.export(limit))
 
 
 @login_required
 def reload_fsm(request):
-    for language in dengue_bot_fsms.keys():
-        dengue_bot_fsms[language] = _generate_fsm(language)
-    messages.success(request, 'Reload Success')
+    # Every worker rebuilds its FSMs in background once it sees the new version
+    version = fsm_config_version()
+    cache.set(FSM_VERSION_KEY, version, None)
+    _check_fsm_version(force=True)
+    messages.success(request, 'Reload of version {} is broadcast'.format(version[:8]))
     return HttpResponseRedirect('/')
 
 
@@ -292,21 +554,39 @@ def push_msg_result(request):
     content = request.POST['content']
     img = request.POST['img']
     error_msgs = list()
-    users = list()
 
     if not areas_id:
         error_msgs.append('You do not choose any area!')
     if not content and not img:
         error_msgs.append('Either content or image should be added!')
 
+    campaign = None
     if not error_msgs:
-        for area_id in areas_id:
-            users.extend(LineUser.objects.filter(location=MinArea.objects.get(area_id=area_id)))
+        campaign = create_campaign(area_audience(areas_id), content, img)
+        push_engine.start(campaign)
 
-    push_logs = push_msg(line_bot_api, users=users, text=content, img=img)
     return render(request, 'dengue_linebot/push_msg_result.html', {
         'error_msgs': error_msgs,
-        'push_logs': push_logs
+        'campaign': campaign
+    })
+
+
+@login_required
+def push_campaign_detail(request, campaign_id):
+    campaign = get_object_or_404(PushCampaign, id=campaign_id)
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'id': campaign.id,
+            'status': campaign.status,
+            'total_users': campaign.total_users,
+            'sent_users': campaign.sent_users,
+            'failed_users': campaign.failed_users,
+        })
+
+    failed_batches = campaign.batches.filter(status=PushBatch.FAILED).order_by('index')
+    return render(request, 'dengue_linebot/push_campaign_detail.html', {
+        'campaign': campaign,
+        'failed_batches': failed_batches
     })
 
 
@@ -102,3 +102,62 @@ STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
 LOGIN_URL = '/login/'
+
+# Line Bot
+# Queue webhook events and process them with `manage.py run_bot_workers`
+DENGUE_BOT_ASYNC_WEBHOOK = False
+# Number of threads that handle events of different users in parallel
+DENGUE_BOT_EVENT_SHARDS = 4
+# Message logs are written in batches of this many rows
+DENGUE_BOT_LOG_FLUSH_ROWS = 100
+# Milliseconds between two flushes of message logs, 0 to flush at the end of each request
+DENGUE_BOT_LOG_FLUSH_INTERVAL = 0
+# Message logs beyond this many buffered rows are dropped
+DENGUE_BOT_LOG_BUFFER_LIMIT = 10000
+# Build the FSMs of all the languages when the WSGI application is loaded (before uWSGI forks)
+DENGUE_BOT_PREBUILD_FSM = True
+# Seconds between two checks of the FSM version broadcast by reload_fsm
+DENGUE_BOT_FSM_VERSION_CHECK_INTERVAL = 5
+# Directory of the parsed FSM config artifacts, empty to disable
+DENGUE_BOT_FSM_CACHE_DIR = os.path.join(BASE_DIR, '.fsm_cache')
+# Fraction of events whose FSM conditions and operations are traced, 0 to disable
+DENGUE_BOT_FSM_TRACE_SAMPLE_RATE = 0.01
+# Number of latest traces kept by each worker
+DENGUE_BOT_FSM_TRACE_BUFFER_SIZE = 1000
+# Max concurrent requests (and kept-alive connections) to each host of outbound calls
+DENGUE_BOT_HTTP_MAX_CONNECTIONS = 10
+# Seconds to connect to and to read from the hosts of outbound calls
+DENGUE_BOT_HTTP_CONNECT_TIMEOUT = 3.05
+DENGUE_BOT_HTTP_READ_TIMEOUT = 10
+# Number of multicast requests sent at the same time by a push job
+DENGUE_BOT_PUSH_CONCURRENCY = 4
+# Max multicast requests per second of all the workers together, counted in the (Redis) cache
+DENGUE_BOT_PUSH_RATE = 100
+# Retries of a multicast request answered with 429 or 5xx, and seconds before the first retry
+DENGUE_BOT_PUSH_MAX_RETRIES = 5
+DENGUE_BOT_PUSH_BACKOFF = 1
+# Number of finished multicast batches whose results are committed at once
+DENGUE_BOT_PUSH_COMMIT_BATCHES = 10
+# Seconds between two heartbeats of a running push campaign, well under the --heartbeat-timeout of run_push_campaigns
+DENGUE_BOT_PUSH_HEARTBEAT_INTERVAL = 30
+# Backend that geocodes the addresses sent by users, and the keyword arguments to build it
+DENGUE_BOT_GEOCODER_BACKEND = 'dengue_linebot.geocoding.GoogleV3Backend'
+DENGUE_BOT_GEOCODER_OPTIONS = {}
+# Max number of geocoded addresses kept in each process
+DENGUE_BOT_GEOCODE_CACHE_SIZE = 10000
+# Seconds before an address that is not found is geocoded again
+DENGUE_BOT_GEOCODE_NEGATIVE_TTL = 24 * 60 * 60
+
+# Hospital
+# Answer nearby hospital queries with an in-memory spatial index instead of PostGIS
+HOSPITAL_SPATIAL_INDEX = True
+# Databases whose spatial index is built when the WSGI application is loaded (before uWSGI forks)
+HOSPITAL_PREBUILD_INDEX_DATABASES = ['tainan']
+# Seconds between two checks of whether the hospital table has changed
+HOSPITAL_INDEX_CHECK_INTERVAL = 5
+# Degrees of longitude and latitude covered by a cell of the spatial index
+HOSPITAL_INDEX_CELL_DEGREES = 0.05
+# Length of the geohash of a cell whose nearby hospitals are cached, 0 to disable the cache
+HOSPITAL_NEARBY_CACHE_PRECISION = 7
+# Max number of cached cells in each process
+HOSPITAL_NEARBY_CACHE_SIZE = 10000
@@ -9,8 +9,18 @@ https://docs.djangoproject.com/en/1.10/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "denguefever_tw.settings.local")
 
 application = get_wsgi_application()
+
+# uWSGI loads this module in the master, so the workers inherit the FSMs and hospital indexes at fork
+if settings.DENGUE_BOT_PREBUILD_FSM:
+    from dengue_linebot.views import prebuild_fsms
+    prebuild_fsms()
+
+if settings.HOSPITAL_SPATIAL_INDEX:
+    from hospital.spatial_index import prebuild_indexes
+    prebuild_indexes(settings.HOSPITAL_PREBUILD_INDEX_DATABASES)
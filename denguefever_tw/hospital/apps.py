@@ -3,3 +3,12 @@ from django.apps import AppConfig
 
 class HospitalConfig(AppConfig):
     name = 'hospital'
+
+    def ready(self):
+        from django.db.models.signals import post_delete, post_save
+        from .models import Hospital
+        from .spatial_index import on_hospital_changed
+
+        # Keep the spatial index of every process up to date
+        post_save.connect(on_hospital_changed, sender=Hospital)
+        post_delete.connect(on_hospital_changed, sender=Hospital)
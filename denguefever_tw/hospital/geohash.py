@@ -0,0 +1,46 @@
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def _spread(value):
+    """Put a zero bit between every two bits of a 32-bit integer."""
+    value &= 0xFFFFFFFF
+    value = (value | value << 16) & 0x0000FFFF0000FFFF
+    value = (value | value << 8) & 0x00FF00FF00FF00FF
+    value = (value | value << 4) & 0x0F0F0F0F0F0F0F0F
+    value = (value | value << 2) & 0x3333333333333333
+    value = (value | value << 1) & 0x5555555555555555
+    return value
+
+
+def encode(lng, lat, precision):
+    """Geohash of a point with precision (at most 12) characters."""
+    bit_count = precision * 5
+    lng_bit_count = (bit_count + 1) // 2
+    lat_bit_count = bit_count // 2
+    x = min(int((lng + 180) / 360 * (1 << lng_bit_count)), (1 << lng_bit_count) - 1)
+    y = min(int((lat + 90) / 180 * (1 << lat_bit_count)), (1 << lat_bit_count) - 1)
+
+    # Bits interleave from the most significant one, starting with longitude
+    code = _spread(x) << (1 - bit_count % 2) | _spread(y) << (bit_count % 2)
+    return ''.join(BASE32[code >> shift & 31] for shift in range(bit_count - 5, -1, -5))
+
+
+def bounds(geohash):
+    """Bounds of a geohash cell.
+
+    Returns:
+        Tuple[float, float, float, float]: min lng, min lat, max lng and max lat
+    """
+    lng_range, lat_range = [-180.0, 180.0], [-90.0, 90.0]
+    is_lng = True
+    for char in geohash:
+        bits = BASE32.index(char)
+        for shift in range(4, -1, -1):
+            value_range = lng_range if is_lng else lat_range
+            mid = (value_range[0] + value_range[1]) / 2
+            if bits >> shift & 1:
+                value_range[0] = mid
+            else:
+                value_range[1] = mid
+            is_lng = not is_lng
+    return lng_range[0], lat_range[0], lng_range[1], lat_range[1]
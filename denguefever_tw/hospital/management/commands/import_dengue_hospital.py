@@ -1,15 +1,17 @@
+from django.contrib.gis.geos import Point
+from django.db import transaction
 from django.db.utils import IntegrityError
 from django.core.management.base import BaseCommand
 
 import csv
-import logging
 
 import shortuuid
 
 from ...models import Hospital
+from ...spatial_index import bump_index_version
 
 
-logger = logging.getLogger(__name__)
+UPDATE_FIELDS = ['phone', 'lng', 'lat', 'location']
 
 
 class Command(BaseCommand):
@@ -24,26 +26,130 @@ class Command(BaseCommand):
             '--database',
             default='tainan'
         )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Validate and count the rows without writing them'
+        )
 
     def handle(self, *args, **options):
-        with open(options['path'], 'r') as input_data:
-            data = csv.reader(input_data, delimiter='\t')
-            for row in data:
-                name, address, phone, lat, lng = row
-                logger.info(row)
+        """Upsert the hospitals of a TSV of name, address, phone, lat and lng.
 
+        A hospital is identified by its name and address. Its phone and
+        location are updated when they differ from the TSV, and rows that are
+        invalid or repeat a hospital are rejected.
+        """
+        database = options['database']
+        self.dry_run = options['dry_run']
+        self.counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'rejected': 0}
+
+        existing_hospitals = {
+            (hospital.name, hospital.address): hospital
+            for hospital in Hospital.objects.using(database)
+                                            .only('hospital_id', 'name', 'address', 'phone', 'lng', 'lat')
+                                            .order_by('-hospital_id')
+        }
+        seen_keys = set()
+        new_hospitals, changed_hospitals = list(), list()
+
+        with open(options['path'], 'r') as input_data:
+            for line_number, row in enumerate(csv.reader(input_data, delimiter='\t'), start=1):
                 try:
+                    name, address, phone, lat, lng = self.validate(row)
+                except ValueError as e:
+                    self.reject(line_number, row, str(e))
+                    continue
 
-                    hospital = Hospital(
+                key = (name, address)
+                if key in seen_keys:
+                    self.reject(line_number, row, 'repeated hospital')
+                    continue
+                seen_keys.add(key)
+
+                hospital = existing_hospitals.get(key)
+                if hospital is None:
+                    new_hospitals.append(Hospital(
                         hospital_id=shortuuid.uuid(),
                         name=name,
                         address=address,
                         phone=phone,
                         opening_hours='',
                         lng=lng,
-                        lat=lat
-                    )
-                    hospital.save(using=options['database'])
-                except IntegrityError:
-                    print('data have already been imported')
-                    break
+                        lat=lat,
+                        location=Point(lng, lat)
+                    ))
+                elif (hospital.phone, hospital.lng, hospital.lat) != (phone, lng, lat):
+                    hospital.phone, hospital.lng, hospital.lat = phone, lng, lat
+                    hospital.location = Point(lng, lat)
+                    changed_hospitals.append(hospital)
+                else:
+                    self.counts['unchanged'] += 1
+
+                if len(new_hospitals) >= options['batch_size']:
+                    self.insert(new_hospitals, database)
+                    new_hospitals = list()
+                if len(changed_hospitals) >= options['batch_size']:
+                    self.update(changed_hospitals, database)
+                    changed_hospitals = list()
+
+        self.insert(new_hospitals, database)
+        self.update(changed_hospitals, database)
+
+        if not self.dry_run and (self.counts['inserted'] or self.counts['updated']):
+            # Bulk writes skip the signals that refresh the spatial index
+            bump_index_version(database)
+
+        self.stdout.write('{}Inserted: {inserted}, Updated: {updated}, Unchanged: {unchanged}, '
+                          'Rejected: {rejected}'.format('[Dry Run] ' if self.dry_run else '', **self.counts))
+
+    @staticmethod
+    def validate(row):
+        if len(row) != 5:
+            raise ValueError('expected 5 columns but got {}'.format(len(row)))
+
+        name, address, phone, lat, lng = (column.strip() for column in row)
+        if not name or not address:
+            raise ValueError('name and address are required')
+        lat, lng = float(lat), float(lng)
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            raise ValueError('location ({}, {}) is out of range'.format(lat, lng))
+        return name, address, phone, lat, lng
+
+    def reject(self, line_number, row, reason):
+        self.counts['rejected'] += 1
+        self.stderr.write('Line {}: {} ({})'.format(line_number, reason, '\t'.join(row)))
+
+    def insert(self, hospitals, database):
+        if not hospitals:
+            return
+        if self.dry_run:
+            self.counts['inserted'] += len(hospitals)
+            return
+
+        try:
+            with transaction.atomic(using=database):
+                Hospital.objects.using(database).bulk_create(hospitals)
+            self.counts['inserted'] += len(hospitals)
+        except IntegrityError:
+            # Find the offending rows one by one
+            for hospital in hospitals:
+                try:
+                    with transaction.atomic(using=database):
+                        Hospital.objects.using(database).bulk_create([hospital])
+                    self.counts['inserted'] += 1
+                except IntegrityError as e:
+                    self.counts['rejected'] += 1
+                    self.stderr.write('Fail to insert {} ({})'.format(hospital.name, str(e).strip()))
+
+    def update(self, hospitals, database):
+        if not hospitals:
+            return
+        if not self.dry_run:
+            with transaction.atomic(using=database):
+                Hospital.objects.using(database).bulk_update(hospitals, UPDATE_FIELDS)
+        self.counts['updated'] += len(hospitals)
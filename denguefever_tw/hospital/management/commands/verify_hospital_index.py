@@ -0,0 +1,66 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+import random
+
+from ...models import Hospital
+from ...spatial_index import get_index
+from ...utils import get_nearby_hospital_postgis
+
+
+class Command(BaseCommand):
+    help = 'Compare nearby hospitals found by the spatial index with those found by PostGIS'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--database',
+            default='tainan'
+        )
+        parser.add_argument(
+            '--samples',
+            type=int,
+            default=100
+        )
+        parser.add_argument(
+            '--distance',
+            type=float,
+            default=5
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=3
+        )
+
+    def handle(self, *args, **options):
+        database = options['database']
+        hospitals = list(Hospital.objects.using(database).values_list('lng', 'lat'))
+        if not hospitals:
+            self.stderr.write('No hospital in {}'.format(database))
+            return
+
+        index = get_index(database)
+        # Jitter around random hospitals so that most of the samples have results
+        jitter = options['distance'] / 111.2
+        mismatches = 0
+        for _ in range(options['samples']):
+            lng, lat = random.choice(hospitals)
+            lng += random.uniform(-jitter, jitter)
+            lat += random.uniform(-jitter, jitter)
+
+            indexed = [row['hospital_id'] for _, row in index.nearby(
+                lng, lat, distance=options['distance'], limit=options['limit']
+            )]
+            expected = [hospital['hospital_id'] for hospital in get_nearby_hospital_postgis(
+                lng, lat, database=database, limit=options['limit'], distance=options['distance'],
+                exclude_fields=['location']
+            )]
+            if indexed != expected:
+                mismatches += 1
+                self.stdout.write('Mismatch at ({}, {})\n index: {}\n postgis: {}'.format(
+                    lng, lat, indexed, expected
+                ))
+
+        self.stdout.write('{} of {} samples mismatch (cell size {} degrees)'.format(
+            mismatches, options['samples'], settings.HOSPITAL_INDEX_CELL_DEGREES
+        ))
@@ -0,0 +1,212 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.forms.models import model_to_dict
+
+import logging
+import math
+import threading
+import uuid
+from collections import OrderedDict, defaultdict
+from time import monotonic
+
+from . import geohash
+from .models import Hospital
+
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE_LAT = EARTH_RADIUS_KM * math.pi / 180
+INDEX_VERSION_KEY = 'hospital_index_version:{}'
+
+logger = logging.getLogger('django')
+
+
+class HospitalIndex:
+    """Grid index of the hospitals of a database.
+
+    Hospitals are bucketed into cells of ``cell_degrees`` of longitude and
+    latitude. A query only visits the cells overlapping the bounding box of its
+    radius, and the candidates are then refined by haversine distance.
+
+    Nearby queries can also be answered through ``nearby_cached``, which
+    caches the candidates of each geohash cell of ``geohash_precision``
+    characters. The cache lives and dies with the index, so it is dropped
+    whenever the hospital table changes.
+
+    Args:
+        hospitals (Iterable[Hospital]): hospitals to index
+        cell_degrees (float): size of a cell
+        geohash_precision (int): length of the geohash of a cached cell
+        cache_size (int): max number of cached geohash cells
+
+    Attributes:
+        version (str): version of the hospital table the index was built from
+    """
+
+    def __init__(self, hospitals, cell_degrees, version=None, *, geohash_precision=7, cache_size=10000):
+        self.cell_degrees = cell_degrees
+        self.version = version
+        self.geohash_precision = geohash_precision
+        self.cache_size = cache_size
+        self._cached_cells = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.rows = list()
+        # Longitude, latitude and cosine of latitude in radians for the haversine refinement
+        self._points = list()
+        self._cells = defaultdict(list)
+        for hospital in hospitals:
+            row = model_to_dict(hospital, exclude=['location'])
+            self._cells[self._cell_of(hospital.lng, hospital.lat)].append(len(self.rows))
+            self.rows.append(row)
+            lat = math.radians(hospital.lat)
+            self._points.append((math.radians(hospital.lng), lat, math.cos(lat)))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def nearby(self, lng, lat, *, distance, limit=None):
+        """Hospitals within distance kilometers, nearest first.
+
+        Returns:
+            List[Tuple[float, dict]]: distance in kilometers and fields of each hospital
+        """
+        return self._refine(lng, lat, self._candidates(lng, lat, distance), distance, limit)
+
+    def nearby_cached(self, lng, lat, *, distance, limit=None):
+        """Same as ``nearby``, with the candidates cached by the geohash cell of the point.
+
+        The candidates of a cell are the hospitals within distance plus the
+        half diagonal of the cell from its center, a superset of the hospitals
+        within distance of any point in the cell. The exact distance of each
+        candidate to the point is then checked again.
+        """
+        cell = geohash.encode(lng, lat, self.geohash_precision)
+        key = (cell, distance)
+        with self._cache_lock:
+            candidates = self._cached_cells.get(key)
+            if candidates is not None:
+                self._cached_cells.move_to_end(key)
+
+        if candidates is None:
+            min_lng, min_lat, max_lng, max_lat = geohash.bounds(cell)
+            center_lng, center_lat = (min_lng + max_lng) / 2, (min_lat + max_lat) / 2
+            half_diagonal = max(self._distance(center_lng, center_lat, corner_lng, corner_lat)
+                                for corner_lng in (min_lng, max_lng)
+                                for corner_lat in (min_lat, max_lat))
+            candidates = [
+                index for _, index in self._refine(center_lng, center_lat,
+                                                   self._candidates(center_lng, center_lat,
+                                                                    distance + half_diagonal),
+                                                   distance + half_diagonal, with_index=True)
+            ]
+            with self._cache_lock:
+                self._cached_cells[key] = candidates
+                if len(self._cached_cells) > self.cache_size:
+                    self._cached_cells.popitem(last=False)
+
+        return self._refine(lng, lat, candidates, distance, limit)
+
+    def _candidates(self, lng, lat, distance):
+        lat_span = distance / KM_PER_DEGREE_LAT
+        cos_lat = math.cos(math.radians(min(abs(lat) + lat_span, 90)))
+        # Near the poles a degree of longitude shrinks to nothing, so visit every cell
+        lng_span = distance / (KM_PER_DEGREE_LAT * cos_lat) if cos_lat > 1e-6 else 180
+
+        min_x, min_y = self._cell_of(lng - lng_span, lat - lat_span)
+        max_x, max_y = self._cell_of(lng + lng_span, lat + lat_span)
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > len(self._cells):
+            return [index for cell in self._cells.values() for index in cell]
+        return [
+            index
+            for x in range(min_x, max_x + 1)
+            for y in range(min_y, max_y + 1)
+            for index in self._cells.get((x, y), ())
+        ]
+
+    def _refine(self, lng, lat, candidates, distance, limit=None, with_index=False):
+        rad_lng, rad_lat = math.radians(lng), math.radians(lat)
+        cos_rad_lat = math.cos(rad_lat)
+        rad_lat_span = distance / EARTH_RADIUS_KM
+        # Compare haversine terms so that asin and sqrt run only for the results
+        max_a = math.sin(min(rad_lat_span, math.pi) / 2) ** 2
+        results = list()
+        for index in candidates:
+            point_lng, point_lat, point_cos_lat = self._points[index]
+            if abs(point_lat - rad_lat) > rad_lat_span:
+                continue
+            a = (math.sin((point_lat - rad_lat) / 2) ** 2 +
+                 cos_rad_lat * point_cos_lat * math.sin((point_lng - rad_lng) / 2) ** 2)
+            if a <= max_a:
+                row_distance = 2 * EARTH_RADIUS_KM * math.asin(min(1, math.sqrt(a)))
+                results.append((row_distance, index if with_index else self.rows[index]))
+
+        results.sort(key=lambda result: result[0])
+        return results[:limit] if limit else results
+
+    @staticmethod
+    def _distance(lng1, lat1, lng2, lat2):
+        lng1, lat1, lng2, lat2 = map(math.radians, (lng1, lat1, lng2, lat2))
+        a = (math.sin((lat2 - lat1) / 2) ** 2 +
+             math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+        return 2 * EARTH_RADIUS_KM * math.asin(min(1, math.sqrt(a)))
+
+    def _cell_of(self, lng, lat):
+        return math.floor(lng / self.cell_degrees), math.floor(lat / self.cell_degrees)
+
+
+_indexes = dict()
+_checked_times = dict()
+_lock = threading.Lock()
+
+
+def get_index(database):
+    """Index of the hospitals in database, rebuilt when the table has changed.
+
+    The version of the table is read from the cache at most once per
+    HOSPITAL_INDEX_CHECK_INTERVAL seconds.
+    """
+    index = _indexes.get(database)
+    now = monotonic()
+    if index is not None and now - _checked_times.get(database, 0) < settings.HOSPITAL_INDEX_CHECK_INTERVAL:
+        return index
+
+    _checked_times[database] = now
+    version = cache.get(INDEX_VERSION_KEY.format(database))
+    if index is not None and index.version == version:
+        return index
+
+    with _lock:
+        index = _indexes.get(database)
+        if index is None or index.version != version:
+            index = HospitalIndex(Hospital.objects.using(database).all(),
+                                  settings.HOSPITAL_INDEX_CELL_DEGREES, version,
+                                  geohash_precision=settings.HOSPITAL_NEARBY_CACHE_PRECISION,
+                                  cache_size=settings.HOSPITAL_NEARBY_CACHE_SIZE)
+            _indexes[database] = index
+            logger.info('Hospital index of %s is built with %s hospitals', database, len(index))
+    return index
+
+
+def prebuild_indexes(databases):
+    """Build the indexes of databases before uWSGI forks, so that no user waits for them.
+
+    A failure is logged, and the index is then built by the first query.
+    """
+    for database in databases:
+        try:
+            get_index(database)
+        except Exception as e:
+            logger.exception('Fail to prebuild hospital index of %s.\n %s', database, str(e))
+        finally:
+            # Forked workers must not share the connection of the master
+            connections[database].close()
+
+
+def bump_index_version(database):
+    """Make every process rebuild its index of database on its next check."""
+    cache.set(INDEX_VERSION_KEY.format(database), uuid.uuid4().hex, None)
+
+
+def on_hospital_changed(sender, instance, using, **kwargs):
+    _indexes.pop(using, None)
+    bump_index_version(using)
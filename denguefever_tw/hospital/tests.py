@@ -1,3 +1,114 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+import math
+import random
+
+from . import geohash
+from .models import Hospital
+from .spatial_index import EARTH_RADIUS_KM, HospitalIndex
+
+
+def haversine(lng1, lat1, lng2, lat2):
+    lng1, lat1, lng2, lat2 = map(math.radians, (lng1, lat1, lng2, lat2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1, math.sqrt(a)))
+
+
+def bisection_encode(lng, lat, precision):
+    """Geohash by halving the ranges of longitude and latitude bit by bit."""
+    ranges = {True: [-180.0, 180.0], False: [-90.0, 90.0]}
+    value = {True: lng, False: lat}
+    code, is_lng = 0, True
+    for _ in range(precision * 5):
+        low, high = ranges[is_lng]
+        mid = (low + high) / 2
+        if value[is_lng] >= mid:
+            code = code << 1 | 1
+            ranges[is_lng][0] = mid
+        else:
+            code <<= 1
+            ranges[is_lng][1] = mid
+        is_lng = not is_lng
+    return ''.join(geohash.BASE32[code >> shift & 31] for shift in range(precision * 5 - 5, -1, -5))
+
+
+def random_hospitals(count, seed=0):
+    """Hospitals scattered over Tainan."""
+    rand = random.Random(seed)
+    return [
+        Hospital(hospital_id=str(index), name='hospital-{}'.format(index), address='', phone='',
+                 opening_hours='', lng=rand.uniform(120.0, 120.6), lat=rand.uniform(22.85, 23.3))
+        for index in range(count)
+    ]
+
+
+def summarize(results):
+    return [(round(distance, 9), row['name']) for distance, row in results]
+
+
+class GeohashTest(SimpleTestCase):
+    def test_encode_known_geohashes(self):
+        self.assertEqual(geohash.encode(-5.6, 42.6, 5), 'ezs42')
+        self.assertEqual(geohash.encode(10.40744, 57.64911, 11), 'u4pruydqqvj')
+
+    def test_encode_same_as_bisection(self):
+        rand = random.Random(0)
+        points = [(-180, -90), (180, 90), (0, 0), (-180, 90), (180, -90)]
+        points.extend((rand.uniform(-180, 180), rand.uniform(-90, 90)) for _ in range(2000))
+        for lng, lat in points:
+            for precision in range(1, 13):
+                self.assertEqual(geohash.encode(lng, lat, precision), bisection_encode(lng, lat, precision),
+                                 (lng, lat, precision))
+
+    def test_bounds_contain_point(self):
+        rand = random.Random(1)
+        for _ in range(500):
+            lng, lat = rand.uniform(-180, 180), rand.uniform(-90, 90)
+            precision = rand.randint(1, 12)
+            min_lng, min_lat, max_lng, max_lat = geohash.bounds(geohash.encode(lng, lat, precision))
+            self.assertTrue(min_lng <= lng <= max_lng and min_lat <= lat <= max_lat, (lng, lat, precision))
+            self.assertAlmostEqual(max_lng - min_lng, 360 / 2 ** ((precision * 5 + 1) // 2))
+            self.assertAlmostEqual(max_lat - min_lat, 180 / 2 ** (precision * 5 // 2))
+
+
+class HospitalIndexTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.hospitals = random_hospitals(500)
+        cls.index = HospitalIndex(cls.hospitals, cell_degrees=0.05)
+
+    def brute_force(self, lng, lat, distance):
+        results = [(haversine(lng, lat, hospital.lng, hospital.lat), {'name': hospital.name})
+                   for hospital in self.hospitals]
+        return sorted((result for result in results if result[0] <= distance), key=lambda result: result[0])
+
+    def test_nearby_same_as_brute_force(self):
+        rand = random.Random(1)
+        for _ in range(300):
+            lng, lat = rand.uniform(119.95, 120.65), rand.uniform(22.8, 23.35)
+            distance = rand.choice([0.5, 2, 5, 20])
+            self.assertEqual(summarize(self.index.nearby(lng, lat, distance=distance)),
+                             summarize(self.brute_force(lng, lat, distance)), (lng, lat, distance))
+
+    def test_nearby_with_limit(self):
+        nearest = self.index.nearby(120.2, 23.0, distance=20)
+        self.assertEqual(self.index.nearby(120.2, 23.0, distance=20, limit=3), nearest[:3])
+
+    def test_nearby_cached_same_as_nearby(self):
+        index = HospitalIndex(self.hospitals, cell_degrees=0.05, geohash_precision=5, cache_size=50)
+        rand = random.Random(2)
+        # Points around a few centers, so that most queries hit a cached cell
+        centers = [(rand.uniform(120.0, 120.6), rand.uniform(22.85, 23.3)) for _ in range(20)]
+        for _ in range(1000):
+            center_lng, center_lat = rand.choice(centers)
+            lng, lat = center_lng + rand.uniform(-0.03, 0.03), center_lat + rand.uniform(-0.03, 0.03)
+            distance, limit = rand.choice([0.5, 2, 5]), rand.choice([None, 3])
+            self.assertEqual(summarize(index.nearby_cached(lng, lat, distance=distance, limit=limit)),
+                             summarize(index.nearby(lng, lat, distance=distance, limit=limit)),
+                             (lng, lat, distance, limit))
+        self.assertLessEqual(len(index._cached_cells), 50)
+
+    def test_nearby_without_hospitals_around(self):
+        self.assertEqual(self.index.nearby(121.5, 25.0, distance=5), [])
@@ -1,25 +1,76 @@
+from django.conf import settings
 from django.contrib.gis.geos import Point
 from django.contrib.gis.measure import D
 from django.contrib.gis.db.models.functions import Distance
-from django.forms.models import model_to_dict
+
+import logging
 
 from .models import Hospital
+from .spatial_index import get_index
+
+
+logger = logging.getLogger('django')
+
+
+def get_nearby_hospital(lng, lat, *, database='tainan', limit=3, offset=0, distance=5, exclude_fields=None,
+                        with_distance=False):
+    """Hospitals within distance kilometers of (lng, lat), nearest first.
+
+    The in-memory spatial index answers the query unless HOSPITAL_SPATIAL_INDEX
+    is off or the index can not be built, then PostGIS does. Candidates are
+    cached by geohash cell unless HOSPITAL_NEARBY_CACHE_PRECISION is 0.
+
+    Args:
+        limit (int): max number of hospitals, None for all
+        offset (int): number of nearest hospitals to skip
+        with_distance (bool): add the distance in meters as ``distance``
+    """
+    if not exclude_fields:
+        exclude_fields = ['hospital_id', 'location', 'objects']
+
+    lng, lat = to_float(lng), to_float(lat)
+    if settings.HOSPITAL_SPATIAL_INDEX:
+        try:
+            index = get_index(database)
+        except Exception as e:
+            logger.exception('Fail to build hospital index. Fall back to PostGIS.\n %s', str(e))
+        else:
+            nearby = index.nearby_cached if settings.HOSPITAL_NEARBY_CACHE_PRECISION else index.nearby
+            response_data = list()
+            rows = nearby(lng, lat, distance=distance, limit=offset + limit if limit else None)
+            for row_distance, row in rows[offset:]:
+                hospital = {key: value for key, value in row.items() if key not in exclude_fields}
+                if with_distance:
+                    hospital['distance'] = row_distance * 1000
+                response_data.append(hospital)
+            return response_data
+
+    return get_nearby_hospital_postgis(lng, lat, database=database, limit=limit, offset=offset,
+                                       distance=distance, exclude_fields=exclude_fields,
+                                       with_distance=with_distance)
 
 
-def get_nearby_hospital(lng, lat, *, database='tainan', limit=3, distance=5, exclude_fields=None):
+def get_nearby_hospital_postgis(lng, lat, *, database='tainan', limit=3, offset=0, distance=5,
+                                exclude_fields=None, with_distance=False):
     if not exclude_fields:
         exclude_fields = ['hospital_id', 'location', 'objects']
+    fields = [field.name for field in Hospital._meta.concrete_fields if field.name not in exclude_fields]
 
     point = Point(to_float(lng), to_float(lat), srid=4326)
     hospital_set = (
         Hospital.objects.using(database)
                 .annotate(distance=Distance('location', point))
-                .filter(location__distance_lte=(point, D(km=5)))
-                .order_by('distance')[:limit]
+                .filter(location__distance_lte=(point, D(km=distance)))
+                .order_by('distance')
+                .values(*fields, 'distance')[offset:offset + limit if limit else None]
     )
 
-    response_data = [model_to_dict(hospital, exclude=exclude_fields)
-                     for hospital in hospital_set]
+    response_data = list()
+    for hospital in hospital_set:
+        hospital_distance = hospital.pop('distance')
+        if with_distance:
+            hospital['distance'] = hospital_distance.m
+        response_data.append(hospital)
     return response_data
 
 
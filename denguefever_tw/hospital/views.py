@@ -1,16 +1,21 @@
-from django.http import HttpResponse
-from django.forms.models import model_to_dict
+from django.http import HttpResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST, require_GET
-from django.contrib.gis.geos import Point
 from django.contrib.gis.measure import D
-from django.contrib.gis.db.models.functions import Distance
 
 import json
+import math
 import shortuuid
 
 from .models import Hospital
-from .utils import get_nearby_hospital, to_float
+from .utils import get_nearby_hospital
+
+
+DEFAULT_NEARBY_RADIUS = 5
+MAX_NEARBY_RADIUS = 50
+DEFAULT_NEARBY_LIMIT = 100
+MAX_NEARBY_LIMIT = 500
+COMPACT_FIELDS = ('name', 'address', 'phone', 'opening_hours', 'lng', 'lat', 'distance')
 
 
 @csrf_exempt
@@ -39,7 +44,7 @@ def hospital_insert(request):
 
 @require_GET
 def hospital_nearby(request):
-    if not request.user.is_authenticated():
+    if not request.user.is_authenticated:
         return HttpResponse(status=405)
 
     database = request.GET.get('database', '')
@@ -49,18 +54,49 @@ def hospital_nearby(request):
     if not all([database, lng, lat]):
         return HttpResponse(status=406)
 
-    point = Point(to_float(lng), to_float(lat), srid=4326)
-    hospital_set = (
-        Hospital.objects.using(database)
-                .annotate(distance=Distance('location', point))
-                .filter(location__distance_lte=(point, D(km=5)))
-                .order_by('distance')
+    try:
+        lng, lat = float(lng), float(lat)
+        radius = float(request.GET.get('radius', DEFAULT_NEARBY_RADIUS))
+        limit = max(min(int(request.GET.get('limit', DEFAULT_NEARBY_LIMIT)), MAX_NEARBY_LIMIT), 1)
+        offset = max(int(request.GET.get('offset', 0)), 0)
+    except ValueError:
+        return HttpResponse(status=406)
+    if not all(map(math.isfinite, (lng, lat, radius))) or radius <= 0:
+        return HttpResponse(status=406)
+    radius = min(radius, MAX_NEARBY_RADIUS)
+
+    # One more hospital tells whether there is a next page
+    hospitals = get_nearby_hospital(lng, lat, database=database, limit=limit + 1, offset=offset,
+                                    distance=radius, with_distance=True)
+    has_next = len(hospitals) > limit
+
+    response = StreamingHttpResponse(
+        _stream_hospitals(hospitals[:limit], compact=request.GET.get('format') == 'compact'),
+        content_type='application/json'
     )
+    if has_next:
+        response['X-Next-Offset'] = offset + limit
+    return response
+
+
+def _stream_hospitals(hospitals, *, compact):
+    """Serialize hospitals as a JSON list one by one.
+
+    The hospitals are already queried, only the output is streamed so that
+    the whole JSON document is never held in memory.
 
-    EXCLUDED_FIELDS = ['hospital_id', 'location', 'objects']
-    response_data = list()
-    for hospital in hospital_set:
-        response_data_tmp = model_to_dict(hospital, exclude=EXCLUDED_FIELDS)
-        response_data_tmp['distance'] = str(hospital.distance)
-        response_data.append(response_data_tmp)
-    return HttpResponse(json.dumps(response_data), status=200, content_type='application/json')
+    The compact format is an object of the field names and one list of values
+    per hospital, with the distance in meters.
+    """
+    if compact:
+        yield '{{"fields": {}, "rows": ['.format(json.dumps(COMPACT_FIELDS))
+        for index, hospital in enumerate(hospitals):
+            hospital['distance'] = round(hospital['distance'], 1)
+            yield (',' if index else '') + json.dumps([hospital[field] for field in COMPACT_FIELDS])
+        yield ']}'
+    else:
+        yield '['
+        for index, hospital in enumerate(hospitals):
+            hospital['distance'] = str(D(m=hospital['distance']))
+            yield (', ' if index else '') + json.dumps(hospital)
+        yield ']'